@@ -1,5 +1,5 @@
 #!/usr/bin/env python
-import sys
+import sys, os
 import numpy as np
 from scipy.spatial import KDTree, Voronoi
 from math import sqrt
@@ -36,8 +36,12 @@ if len(sys.argv) < 2:
     sys.exit(0)
 
 fname = sys.argv[1]
-data = np.genfromtxt(fname + "_POSITIONS.txt", dtype="i,f,f,i,f,i",
-                     names="f,x,y,lab,ecc,area")
+if os.path.exists(fname + "_POSITIONS.bin"):
+    from posfile import load_positions
+    data = load_positions(fname + "_POSITIONS.bin")
+else:
+    data = np.genfromtxt(fname + "_POSITIONS.txt", dtype="i,f,f,i,f,i",
+                         names="f,x,y,lab,ecc,area")
 frames = [[(row[1], row[2]) for row in data[data['f']==i]] for i in
           range(data[-1][0] + 1)]
 frame_IDs = [[row[3] for row in data[data['f']==i]] for i in
@@ -0,0 +1,79 @@
+""" background.py
+    Streaming model of the illumination of a run of frames, built in the same
+    pass as particle detection: the brightness of each frame (the flicker
+    trace of lighting.py) and a smooth background pattern for flat-fielding
+    the frames before convolution in positions.py.
+"""
+
+import numpy as np
+
+def frame_mean(frame):
+    """ mean of a frame, scaled by the maximum of its integer type """
+    if frame.dtype.kind in 'ui':
+        return frame.mean() / np.iinfo(frame.dtype).max
+    return frame.mean()
+
+def block_median(frame, block):
+    """ block_median(frame, block)
+        the median of each block x block square of the frame, dropping the
+        remainder rows and columns
+    """
+    h, w = max(frame.shape[0]//block, 1), max(frame.shape[1]//block, 1)
+    bh, bw = min(block, frame.shape[0]), min(block, frame.shape[1])
+    blocks = frame[:h*bh, :w*bw].reshape(h, bh, w, bw).swapaxes(1, 2)
+    return np.median(blocks.reshape(h, w, bh*bw), -1)
+
+def upsample(pattern, shape):
+    """ upsample(pattern, shape)
+        bilinear interpolation of pattern, taken as the values at the centers
+        of equal blocks, to an image of shape
+    """
+    axes = []
+    for n, m in zip(shape, pattern.shape):
+        i = ((np.arange(n) + .5)*m/n - .5).clip(0, m - 1)
+        i0 = i.astype(int)
+        i1 = np.minimum(i0 + 1, m - 1)
+        axes.append((i0, i1, i - i0))
+    (r0, r1, fr), (c0, c1, fc) = axes
+    rows = pattern[r0]*(1 - fr[:, None]) + pattern[r1]*fr[:, None]
+    return rows[:, c0]*(1 - fc) + rows[:, c1]*fc
+
+class Background(object):
+    """ Background(rate=0.05, block=32, flatten=True, pattern=None)
+        Running model of the illumination as brightness times pattern. The
+        brightness is frame_mean of each frame. The pattern is the median of
+        each block x block square of the frame divided by its mean, so that
+        flicker does not enter it, and averaged over frames with an
+        exponential running mean at rate. Particles covering less than half
+        of each block do not change the median, nor do particles resting in
+        place for many frames. The pattern may be seeded with that of an
+        earlier model; with rate 0 the seed is kept as it is.
+
+        update(frame) records the brightness of the frame and, if flatten,
+        updates the pattern; flatfield(im) divides the image (of the same
+        shape, as float) by the pattern in place, if flatten.
+    """
+    def __init__(self, rate=0.05, block=32, flatten=True, pattern=None):
+        self.rate = rate
+        self.block = block
+        self.flatten = flatten
+        self.pattern = pattern
+        self.brightness = None
+
+    def update(self, frame):
+        self.brightness = frame_mean(frame)
+        if not self.flatten or (self.pattern is not None and not self.rate):
+            return
+        med = block_median(frame, self.block).astype(float)
+        med /= med.mean() or 1
+        if self.pattern is None or self.pattern.shape != med.shape:
+            self.pattern = med
+        else:
+            self.pattern += self.rate*(med - self.pattern)
+
+    def flatfield(self, im):
+        if self.flatten and self.pattern is not None:
+            # dark blocks (e.g., outside the container) are left as they are
+            flat = upsample(np.maximum(self.pattern, 1e-3), im.shape)
+            im /= flat.astype(im.dtype)
+        return im
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+""" benchmark.py
+    Times the stages of positions.find_particles on synthetic frames of known
+    content, and measures how many of the particles and corner dots it finds.
+
+    Frames show square particles at random positions and orientations, each
+    with a dark center dot and three dark corner dots (the fourth corner is
+    left blank, as on the real particles), on a light background, with
+    gaussian noise and a frame-to-frame flicker of the lighting. The 'small'
+    regime has particles 22 px across (as from the usual camera), 'slr' 92 px
+    (full resolution SLR).
+
+    For each regime and image size, reports the time per frame of each stage
+    (read, normalize, convolve, label, filter_segments, the corner pass and
+    the orientations), the throughput, and the recall and precision of the
+    centers and corners against the true positions.
+"""
+
+import numpy as np
+from scipy.ndimage import imread
+from scipy.spatial import cKDTree
+from os import path
+from time import time
+
+# side of the particle, radii and distance from the center of the dots, in px
+REGIMES = {'small': {'side': 22, 'dot': 4.5, 'cdot': 2., 'rc': 7.},
+           'slr':   {'side': 92, 'dot': 18., 'cdot': 8., 'rc': 29.}}
+
+def synth_frame(shape, side, dot, cdot, rc, density=0.3, noise=0.03, gain=1.,
+                rng=np.random):
+    """ synth_frame(shape, side, dot, cdot, rc, density=0.3, noise=0.03, gain=1.)
+        Draws a frame of the given shape with square particles of side px
+        covering about density of it, each with a center dot of radius dot
+        and corner dots of radius cdot at distance rc from the center along
+        three of its diagonals. The background is 0.9 and the squares 0.6,
+        the dots 0.1, all times gain, with gaussian noise of std noise.
+
+        Returns the frame as uint8, and arrays of the true centers and
+        corners (fields x, y as in positions.py, and orient, as found by
+        orientation.orient_frame, for the centers).
+    """
+    cell = int(np.ceil(side*np.sqrt(2))) + 2
+    half = cell//2
+    # cells far enough from the edges for the jittered squares to fit
+    gx, gy = np.mgrid[half + 2:shape[0] - half - 2:cell, half + 2:shape[1] - half - 2:cell]
+    n = min(gx.size, int(round(density*shape[0]*shape[1]/side**2)))
+    pick = rng.permutation(gx.size)[:n]
+    slack = (cell - side*np.sqrt(2))/2
+    xs = gx.ravel()[pick] + rng.uniform(-slack, slack, n)
+    ys = gy.ravel()[pick] + rng.uniform(-slack, slack, n)
+    angles = rng.uniform(0, 2*np.pi, n)
+
+    im = np.full(shape, 0.9)
+    offs = np.arange(-half, half + 1)
+    corners = []
+    for x, y, a in zip(xs, ys, angles):
+        r0, c0 = int(round(x)), int(round(y))
+        rows, cols = r0 + offs[:, None], c0 + offs[None, :]
+        dx, dy = rows - x, cols - y
+        u = dx*np.cos(a) + dy*np.sin(a)
+        v = -dx*np.sin(a) + dy*np.cos(a)
+        patch = im[r0 - half:r0 + half + 1, c0 - half:c0 + half + 1]
+        patch[(np.abs(u) <= side/2.) & (np.abs(v) <= side/2.)] = 0.6
+        patch[dx**2 + dy**2 <= dot**2] = 0.1
+        for k in range(3):
+            ca = a + np.pi/4 + k*np.pi/2
+            cx, cy = x + rc*np.cos(ca), y + rc*np.sin(ca)
+            patch[(rows - cx)**2 + (cols - cy)**2 <= cdot**2] = 0.1
+            corners.append((cx, cy))
+    im = gain*im + noise*rng.standard_normal(shape)
+    frame = (255*im.clip(0, 1)).astype(np.uint8)
+
+    centers = np.empty(n, [('x', float), ('y', float), ('orient', float)])
+    centers['x'], centers['y'] = xs, ys
+    # the mean direction of the three corners is that of the middle one
+    mid = angles + np.pi/4 + np.pi/2
+    centers['orient'] = np.arctan2(np.cos(mid), np.sin(mid)) % (2*np.pi)
+    cpts = np.empty(len(corners), [('x', float), ('y', float)])
+    if corners:
+        cpts['x'], cpts['y'] = np.array(corners).T
+    return frame, centers, cpts
+
+def match(found, truth, maxdist):
+    """ match(found, truth, maxdist) -> recall, precision, index
+        matches found to truth positions within maxdist; index is, for each
+        of found, the index of its match in truth or -1
+    """
+    if not (len(found) and len(truth)):
+        return 0., 0., -np.ones(len(found), int)
+    dist, idx = cKDTree(np.column_stack((truth['x'], truth['y']))).query(
+                np.column_stack((found['x'], found['y'])), distance_upper_bound=maxdist)
+    ok = np.isfinite(dist)
+    matched = len(np.unique(idx[ok]))
+    return matched/float(len(truth)), matched/float(len(found)), np.where(ok, idx, -1)
+
+def bench_frame(filename, truth, ctruth, regime, thresh=3):
+    """ bench_frame(filename, truth, ctruth, regime) -> times, scores
+        Runs the stages of positions.find_particles on the frame saved at
+        filename with the kernels, areas and corner distance of regime,
+        returning the seconds taken by each stage and the recall and
+        precision of centers and corners and the median orientation error.
+    """
+    import positions as P
+    from orientation import orient_frame
+    side, dot, cdot, rc = regime['side'], regime['dot'], regime['cdot'], regime['rc']
+    times = []
+    t = time()
+    raw = imread(filename)
+    times.append(('read', time() - t))
+
+    t = time()
+    im = P.load_image(raw)
+    times.append(('normalize', time() - t))
+
+    t = time()
+    kern = -dot
+    convolved, cut = P.convolve_thresh(im, thresh, csize=kern)[:2]
+    times.append(('convolve', time() - t))
+
+    t = time()
+    labels = P.label(convolved > cut)
+    times.append(('label', time() - t))
+
+    t = time()
+    area = np.pi*dot**2
+    pts = P.filter_segments(labels, max_ecc=.8, min_area=area/4, max_area=2*area,
+                            intensity=1 - im)
+    times.append(('filter', time() - t))
+
+    t = time()
+    carea = np.pi*cdot**2
+    cpts = P.find_particles(im, method='convolve', rmv=(pts, dot),
+                            csize=-cdot, max_ecc=.8, min_area=carea/4,
+                            max_area=2*carea)[0]
+    times.append(('corners', time() - t))
+
+    t = time()
+    orient = orient_frame(pts, cpts, 3, rc, np.sqrt(rc))
+    times.append(('orient', time() - t))
+
+    recall, precision, idx = match(pts, truth, side/4.)
+    crecall, cprecision = match(cpts, ctruth, cdot)[:2]
+    ok = (idx >= 0) & np.isfinite(orient)
+    err = np.abs((orient[ok] - truth['orient'][idx[ok]] + np.pi) % (2*np.pi) - np.pi)
+    scores = (recall, precision, crecall, cprecision,
+              np.degrees(np.median(err)) if ok.any() else np.nan)
+    return times, scores
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    from tempfile import mkdtemp
+    from shutil import rmtree
+    from PIL import Image
+
+    parser = ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--regime', nargs='+', default=sorted(REGIMES),
+                        choices=sorted(REGIMES), help='Particle sizes to test')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[512, 1024, 2048],
+                        help='Sides of the square frames, in px')
+    parser.add_argument('--frames', type=int, default=4,
+                        help='Frames per regime and size')
+    parser.add_argument('--density', type=float, default=.3,
+                        help='Fraction of the frame covered by particles')
+    parser.add_argument('--noise', type=float, default=.03,
+                        help='Standard deviation of the noise, in units of full brightness')
+    parser.add_argument('--flicker', type=float, default=.05,
+                        help='Amplitude of the flicker of the lighting, relative')
+    parser.add_argument('--format', default='png', choices=['png', 'tif', 'jpg'],
+                        help='File format of the frames, for the read stage')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the random frames')
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    tmp = mkdtemp()
+    stages = ['read', 'normalize', 'convolve', 'label', 'filter', 'corners', 'orient']
+    print '{:>6s} {:>5s} {:>5s}'.format('regime', 'size', 'count'),
+    print ' '.join('{:>9s}'.format(s) for s in stages),
+    print '{:>7s} {:>6s} {:>7s} {:>7s} {:>7s} {:>7s} {:>6s}'.format(
+            'frame/s', 'Mpx/s', 'recall', 'precis', 'crecall', 'cprecis', 'orient')
+    print '{:>18s}'.format(''), ' '.join('{:>9s}'.format('ms') for s in stages),
+    print '{:>55s}'.format('deg')
+    try:
+        for name in args.regime:
+            regime = REGIMES[name]
+            for size in args.sizes:
+                times, scores, count = [], [], 0
+                for n in xrange(args.frames):
+                    gain = 1 + args.flicker*np.sin(2*np.pi*n/args.frames)
+                    frame, truth, ctruth = synth_frame((size, size), gain=gain,
+                            density=args.density, noise=args.noise, rng=rng, **regime)
+                    filename = path.join(tmp, 'frame_{}.{}'.format(n, args.format))
+                    Image.fromarray(frame).save(filename)
+                    t, s = bench_frame(filename, truth, ctruth, regime)
+                    times.append([dt for _, dt in t])
+                    scores.append(s)
+                    count += len(truth)
+                times = np.mean(times, 0)
+                scores = np.nanmean(scores, 0)
+                total = times.sum()
+                print '{:>6s} {:5d} {:5d}'.format(name, size, count//args.frames),
+                print ' '.join('{:9.1f}'.format(1e3*dt) for dt in times),
+                print '{:7.2f} {:6.2f} {:7.3f} {:6.3f} {:7.3f} {:7.3f} {:6.1f}'.format(
+                        1/total, size*size/total/1e6, *scores)
+    finally:
+        rmtree(tmp)
@@ -0,0 +1,252 @@
+""" frames.py
+    Frame sources for positions.py and lighting.py.
+
+    A source is indexed by frame number and returns the image as an array:
+    FileFrames reads one image file per frame, TiffStack the pages of a
+    multi-page tiff, and RawStack a raw dump of frames from the camera.
+    Stacks are memory-mapped where the layout allows. Prefetch wraps a
+    source to keep the next few frames decoded in a background thread.
+
+    Sources open their files lazily in each process, so they can be handed
+    to multiprocessing workers, and count their frames only once. watch_files follows the files of a run as
+    they are written.
+"""
+
+import numpy as np
+from os import path, getpid
+from glob import glob
+from time import time, sleep
+from threading import Thread, Condition, Lock
+from Queue import Queue
+from scipy.ndimage import imread
+from PIL import Image
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+class FileFrames(object):
+    """ FileFrames(filenames)
+        one image file per frame
+    """
+    def __init__(self, filenames):
+        self.filenames = filenames
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __getitem__(self, n):
+        return imread(self.filenames[n])
+
+    def name(self, n):
+        return self.filenames[n]
+
+class _Stack(object):
+    """ base for sources of many frames in one file, opened once per process;
+        the number of frames is counted once and kept
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._pid = self._frames = self._lock = self._len = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pid'] = state['_frames'] = state['_lock'] = None
+        return state
+
+    @property
+    def frames(self):
+        if self._pid != getpid():
+            self._frames = self._open()
+            self._lock = Lock()
+            self._pid = getpid()
+        return self._frames
+
+    def __len__(self):
+        if self._len is None:
+            self._len = self._count()
+        return self._len
+
+    def name(self, n):
+        base, ext = path.splitext(self.filename)
+        return '{}_{:05d}{}'.format(base, n, ext)
+
+class TiffStack(_Stack):
+    """ TiffStack(filename)
+        the pages of a multi-page tiff; memory-mapped by tifffile if it is
+        installed and the pages are contiguous and uncompressed, otherwise
+        read page by page with PIL
+    """
+    def _open(self):
+        if tifffile is not None:
+            try:
+                return tifffile.memmap(self.filename, mode='r')
+            except ValueError:
+                pass
+        return Image.open(self.filename)
+
+    def _count(self):
+        frames = self.frames
+        if isinstance(frames, np.ndarray):
+            return len(frames) if frames.ndim > 2 else 1
+        n = 0
+        with self._lock:
+            while True:
+                try:
+                    frames.seek(n)
+                except EOFError:
+                    return n
+                n += 1
+
+    def __getitem__(self, n):
+        frames = self.frames
+        if isinstance(frames, np.ndarray):
+            return frames[n] if frames.ndim > 2 else frames
+        # the one PIL image is shared by all threads, so seek and read
+        # the page at once
+        with self._lock:
+            frames.seek(n)
+            return np.array(frames)
+
+class RawStack(_Stack):
+    """ RawStack(filename, shape, dtype='<u2', offset=0)
+        a raw dump of frames of given shape (rows, cols) and dtype,
+        after a header of offset bytes; memory-mapped
+    """
+    def __init__(self, filename, shape, dtype='<u2', offset=0):
+        _Stack.__init__(self, filename)
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.offset = offset
+
+    def _open(self):
+        nbytes = path.getsize(self.filename) - self.offset
+        nframes = nbytes // (self.dtype.itemsize*np.prod(self.shape))
+        return np.memmap(self.filename, self.dtype, 'r', self.offset,
+                         (nframes,) + self.shape)
+
+    def _count(self):
+        return len(self.frames)
+
+    def __getitem__(self, n):
+        return np.array(self.frames[n])
+
+def open_frames(filenames, raw_shape=None, raw_dtype='<u2', raw_offset=0):
+    """ open_frames(filenames, raw_shape=None, raw_dtype='<u2', raw_offset=0)
+        returns the frame source for the files: a RawStack if raw_shape is
+        given, a TiffStack for a single tiff file, else FileFrames
+    """
+    if len(filenames) == 1:
+        filename, = filenames
+        if raw_shape is not None:
+            return RawStack(filename, raw_shape, raw_dtype, raw_offset)
+        elif filename.lower().endswith(('.tif', '.tiff')):
+            stack = TiffStack(filename)
+            if len(stack) > 1:
+                return stack
+    return FileFrames(filenames)
+
+class Prefetch(object):
+    """ Prefetch(source, depth=4, chunk=0)
+        wraps a frame source so that asking for frame n also queues frames
+        n+1 to n+depth to be read by a background thread, which skips any
+        requests that have fallen behind. If chunk, frames are handed out
+        in chunks of that many (as by Pool.imap with chunksize), and only
+        the frames of the chunk holding n are read ahead, since the next
+        chunk may go to another process.
+    """
+    def __init__(self, source, depth=4, chunk=0):
+        self.source = source
+        self.depth = depth
+        self.chunk = chunk
+        self._pid = None
+        self._len = len(source)
+
+    def __getstate__(self):
+        return {'source': self.source, 'depth': self.depth, 'chunk': self.chunk,
+                '_pid': None, '_len': self._len}
+
+    def __len__(self):
+        return self._len
+
+    def name(self, n):
+        return self.source.name(n)
+
+    def _start(self):
+        self._pid = getpid()
+        self._cond = Condition()
+        self._todo = Queue()
+        self._queued = set()
+        self._done = {}
+        self._current = 0
+        thread = Thread(target=self._read)
+        thread.daemon = True
+        thread.start()
+
+    def _read(self):
+        while True:
+            n = self._todo.get()
+            with self._cond:
+                if n < self._current:
+                    self._queued.discard(n)
+                    continue
+            try:
+                frame = self.source[n]
+            except Exception as e:
+                frame = e
+            with self._cond:
+                self._done[n] = frame
+                self._cond.notify_all()
+
+    def __getitem__(self, n):
+        if self._pid != getpid():
+            self._start()
+        with self._cond:
+            self._current = n
+            stop = min(n + self.depth + 1, self._len)
+            if self.chunk:
+                stop = min(stop, (n//self.chunk + 1)*self.chunk)
+            for m in xrange(n, stop):
+                if m not in self._queued:
+                    self._queued.add(m)
+                    self._todo.put(m)
+            for m in [m for m in self._done if m < n]:
+                del self._done[m]
+                self._queued.discard(m)
+            while n not in self._done:
+                self._cond.wait()
+            frame = self._done.pop(n)
+            self._queued.discard(n)
+        if isinstance(frame, Exception):
+            raise frame
+        return frame
+
+def watch_files(pattern, interval=1., idle=60.):
+    """ watch_files(pattern, interval=1., idle=60.)
+        yields, in sorted order, the files matching the glob pattern as they
+        are completed, polling every interval seconds; a file is complete
+        once its size is the same at two polls, and no file is yielded before
+        the ones sorted ahead of it. Stops when no file has been completed
+        for idle seconds.
+    """
+    done = set()
+    sizes = {}
+    last = time()
+    while True:
+        waiting = False
+        for f in sorted(glob(pattern)):
+            if f in done:
+                continue
+            size = path.getsize(f)
+            if size and sizes.get(f) == size and not waiting:
+                done.add(f)
+                del sizes[f]
+                last = time()
+                yield f
+            else:
+                sizes[f] = size
+                waiting = True
+        if time() - last > idle:
+            return
+        sleep(interval)
@@ -3,6 +3,8 @@
 from matplotlib import pyplot as plt
 import numpy as np
 import sys
+from os import path
+from posfile import histogram_name, load_histograms, ECC_BINS
 
 if len(sys.argv) < 2:
     print("Please specify an argument")
@@ -11,6 +13,23 @@ try:
     fname = ("CORNER_" if sys.argv[2].lower() == 'c' else "") + "POSITIONS"
 except IndexError:
     fname = "POSITIONS"
+hname = histogram_name(fname)
+if path.exists(hname):
+    # histograms saved by positions.py, no need to read the positions
+    hists = load_histograms(hname)
+    if sys.argv[1].lower() == 'ecc':
+        plt.bar(np.arange(ECC_BINS)/float(ECC_BINS), hists.ecc, 1./ECC_BINS)
+        plt.title("Eccentricities")
+    elif sys.argv[1].lower() == 'area':
+        plt.bar(np.arange(len(hists.area)) - .5, hists.area, 1)
+        plt.title("Area")
+    elif sys.argv[1].lower() == 'count':
+        plt.bar(np.arange(len(hists.count)) - .5, hists.count, 1)
+        plt.title("Particles per frame")
+    else:
+        print("Unknown argument")
+    plt.show()
+    sys.exit(0)
 data = np.genfromtxt(fname, dtype='i,f,f,i,f,i', names=True, skip_header=3)
 if sys.argv[1].lower() == 'ecc':
     plt.hist(data["Eccen"], bins=35)
@@ -18,6 +37,9 @@ if sys.argv[1].lower() == 'ecc':
 elif sys.argv[1].lower() == 'area':
     plt.hist(data["Area"], bins=35)
     plt.title("Area")
+elif sys.argv[1].lower() == 'count':
+    plt.hist(np.bincount(data["Frame"]), bins=35)
+    plt.title("Particles per frame")
 else:
     print("Unknown argument")
 plt.show()
@@ -1,5 +1,6 @@
 import numpy as np
 import PIL.Image as image
+from background import frame_mean
 
 from socket import gethostname
 hostname = gethostname()
@@ -11,26 +12,90 @@ else:
     print "computer undefined"
     print "where are you working?"
 
-def im_mean(imf):
+def im_mean(imf, stride=1, reduce=1):
+    """ im_mean(imf, stride=1, reduce=1)
+        mean brightness of an image file, scaled by the maximum of its
+        integer type, from every stride-th pixel of every stride-th row;
+        jpegs are decoded at 1/reduce of the size (2, 4 or 8) by PIL
+    """
     im = image.open(imf)
-    im = np.array(im)
-    im = im / 255.
-    
-    return np.mean(im)
-
-def get_means(fs, prefix='', nthreads=None):
-    from multiprocessing import Pool
-    if nthreads is None or nthreads > 8:
-        nthreads = 8 if computer is 'foppl' else 2
-    elif nthreads > 2 and computer is 'rock':
-        nthreads = 2
-    print "on {}, using {} threads".format(computer,nthreads)
-    pool = Pool(nthreads)
+    if reduce > 1:
+        im.draft(im.mode, (im.size[0]//reduce, im.size[1]//reduce))
+    im = np.asarray(im)[::stride, ::stride]
+    return frame_mean(im)
 
+def _im_mean_task((imf, stride, reduce)):
+    return im_mean(imf, stride, reduce)
+
+def means_cache(fs, *params):
+    """ means_cache(fs, *params)
+        the name of the cache file of get_means for the files fs, next to
+        the first one, keyed by the names, sizes and modification times of
+        the files and the params, so any change to them makes a new cache
+    """
+    import os, hashlib
+    key = hashlib.md5(repr(params))
+    for f in fs:
+        st = os.stat(f)
+        key.update('{}\0{}\0{}\0'.format(f, st.st_size, st.st_mtime))
+    return os.path.join(os.path.dirname(os.path.abspath(fs[0])),
+                        '.means_{}.npy'.format(key.hexdigest()[:16]))
+
+def load_means(tracefile):
+    """ load_means(tracefile)
+        returns the mean brightness of each frame from the lighting trace
+        saved by positions.py --lighting, instead of reading the images again
+    """
+    trace = np.loadtxt(tracefile, ndmin=2)
+    means = np.full(int(trace[:, 0].max()) + 1 if len(trace) else 0, np.nan)
+    means[trace[:, 0].astype(int)] = trace[:, 1]
+    return means
+
+def get_means(fs, prefix='', nthreads=None, raw_shape=None, prefetch=4,
+              stride=1, reduce=1, cache=True):
+    """ get_means(fs, prefix='', nthreads=None, raw_shape=None, prefetch=4,
+                  stride=1, reduce=1, cache=True)
+        returns the mean brightness of each frame; fs is a list of image
+        files, or a single multi-page tiff or raw dump (of frames of shape
+        raw_shape), which is read in order with prefetch frames read ahead
+
+        stride  - use only every stride-th pixel of every stride-th row
+        reduce  - decode jpegs at 1/reduce of their size
+        nthreads - number of processes reading image files, by default
+                   the number of cores
+        cache   - keep the result in a file next to the images, and reuse
+                  it while the files (and these options) are unchanged
+    """
+    from frames import open_frames, FileFrames, Prefetch
     if prefix is not '':
         fs = [prefix + f for f in fs]
-
-    return pool.map(im_mean, fs)
+    if cache:
+        cachefile = means_cache(fs, raw_shape, stride, reduce)
+        try:
+            return np.load(cachefile)
+        except IOError:
+            pass
+    source = open_frames(fs, raw_shape)
+    if not isinstance(source, FileFrames):
+        if prefetch:
+            source = Prefetch(source, prefetch)
+        means = [frame_mean(source[n][::stride, ::stride])
+                 for n in xrange(len(source))]
+    else:
+        from multiprocessing import Pool, cpu_count
+        nthreads = nthreads or cpu_count()
+        print "on {}, using {} threads".format(hostname, nthreads)
+        pool = Pool(nthreads)
+        means = pool.map(_im_mean_task, [(f, stride, reduce) for f in fs],
+                         max(1, len(fs)//(4*nthreads)))
+        pool.close()
+    means = np.array(means)
+    if cache:
+        try:
+            np.save(cachefile, means)
+        except IOError:
+            print "could not save means to", cachefile
+    return means
 
 def plot_means(means,fps=150.,**kwargs):
     if computer is 'foppl':
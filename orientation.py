@@ -192,7 +192,9 @@ def get_angles_loop(data, cdata, framestep=1, nc=3, rc=11, drc=4, do_average=Tru
             data    - data array with 'x' and 'y' fields for particle centers
             cdata   - data array wity 'x' and 'y' fields for corners
             (these arrays need not have the same length,
-                but both must have 'f' field for the image frame)
+                but both must have 'f' field for the image frame;
+                if cdata has a 'center' field, as from positions.py -c,
+                only corners owned by the center with that 'id' are used)
             framestep - only analyze every `framestep` frames
             nc      - number of corner dots
             do_average - whether to average the n corners to one value for return
@@ -215,18 +217,26 @@ def get_angles_loop(data, cdata, framestep=1, nc=3, rc=11, drc=4, do_average=Tru
               ('orient',float,(nc,)),
               ('cdisp',float,(nc,2,))]
     odata = np.zeros(len(data), dtype=dt)
+    owned = 'center' in cdata.dtype.names
+    if owned:
+        corder = np.argsort(cdata['center'])
+        cstarts = np.searchsorted(cdata['center'][corder], data['id'], 'left')
+        cstops = np.searchsorted(cdata['center'][corder], data['id'], 'right')
     frame = 0
-    for datum in data:
+    for i, datum in enumerate(data):
         if datum['f'] % framestep != 0:
             continue
         #if frame != datum['f']:
         #    print 'frame',frame
         frame = datum['f']
         posi = (datum['x'], datum['y'])
+        if owned:
+            icdata = cdata[corder[cstarts[i]:cstops[i]]]
+        else:
+            icdata = cdata[cdata['f']==frame]
         icorner, iorient, idisp = \
             find_corner(np.asarray(posi),
-                        np.column_stack((cdata['x'][cdata['f']==frame],
-                                         cdata['y'][cdata['f']==frame])),
+                        np.column_stack((icdata['x'], icdata['y'])),
                         n=nc, rc=rc, drc=drc, do_average=do_average)
         iid = get_id(data, posi, frame)
         imask = data['id']==iid
@@ -242,6 +252,55 @@ def get_angles_loop(data, cdata, framestep=1, nc=3, rc=11, drc=4, do_average=Tru
 
     return odata, mask
 
+def orient_frame(pts, cpts, nc=3, rc=11, drc=4):
+    """ orient_frame(pts, cpts, nc=3, rc=11, drc=4) -> orient
+        Orientations of all particles of a frame at once, as find_corner
+        gives them: of the corners (array cpts with 'x' and 'y' fields) whose
+        distance from the particle (in pts) is within drc of rc, the nc
+        closest to rc are taken, and the orientation is that of their mean
+        direction, arctan2(x, y) % 2pi of the displacement for nc = 1.
+        Particles with fewer than nc such corners get nan.
+    """
+    from scipy.spatial import cKDTree
+    orient = np.full(len(pts), np.nan)
+    if not (len(pts) and len(cpts)):
+        return orient
+    cxy = np.column_stack((cpts['x'], cpts['y']))
+    near = cKDTree(cxy).query_ball_point(np.column_stack((pts['x'], pts['y'])), rc + drc)
+    i = np.repeat(np.arange(len(pts)), map(len, near))
+    j = np.fromiter((k for ks in near for k in ks), int, len(i))
+    dx, dy = cxy[j, 0] - pts['x'][i], cxy[j, 1] - pts['y'][i]
+    dr = np.abs(np.hypot(dx, dy) - rc)
+    legal = dr < drc
+    i, dx, dy, dr = i[legal], dx[legal], dy[legal], dr[legal]
+
+    # rank the corners of each particle by their distance from rc
+    order = np.lexsort((dr, i))
+    i, dx, dy = i[order], dx[order], dy[order]
+    first = np.searchsorted(i, i)
+    keep = np.arange(len(i)) - first < nc
+    i, dx, dy = i[keep], dx[keep], dy[keep]
+    amp = np.hypot(dx, dy)
+    sx = np.bincount(i, dx/amp, minlength=len(pts))
+    sy = np.bincount(i, dy/amp, minlength=len(pts))
+    found = np.bincount(i, minlength=len(pts)) == nc
+    orient[found] = np.arctan2(sx[found], sy[found]) % (2*np.pi)
+    return orient
+
+def odata_from_orient(data):
+    """ odata_from_orient(data) -> odata, omask
+        the odata and omask of get_angles_loop from the 'orient' field of
+        data, as saved by positions.py --orient; the corners themselves are
+        not saved, so 'corner' and 'cdisp' are left nan
+    """
+    dt = [('corner',float,(2,)),
+          ('orient',float),
+          ('cdisp',float,(2,))]
+    odata = np.empty(len(data), dtype=dt)
+    odata['corner'] = odata['cdisp'] = np.nan
+    odata['orient'] = data['orient']
+    return odata, np.isfinite(odata['orient'])
+
 def plot_orient_hist(odata, figtitle=''):
     if computer is not 'rock':
         print 'computer must be on rock'
@@ -236,9 +236,14 @@ if __name__=='__main__':
         except IOError:
             print prefix+"_CORNER_POSITIONS.npz file not found, have you run `tracks -lc` yet?"
     if findorient:
-        print "calculating orientation data"
-        from orientation import get_angles_loop
-        odata, omask = get_angles_loop(data, cdata, nc=nc, rc=rc, drc=drc)
+        if 'orient' in data.dtype.names:
+            print "using orientation data found by positions.py --orient"
+            from orientation import odata_from_orient
+            odata, omask = odata_from_orient(data)
+        else:
+            print "calculating orientation data"
+            from orientation import get_angles_loop
+            odata, omask = get_angles_loop(data, cdata, nc=nc, rc=rc, drc=drc)
         np.savez(locdir+prefix+'_ORIENTATION.npz',
                 odata=odata,
                 omask=omask)
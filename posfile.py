@@ -0,0 +1,213 @@
+""" posfile.py
+    Reading and writing positions.py output, frame by frame as it is found.
+
+    Text files have the usual four header lines and one row per particle.
+    Binary files (*.bin) have a fixed-size text header followed by records
+    of POS_DTYPE (or CORNER_DTYPE), plus an index file (*.bin.idx) of
+    (frame, first row, number of rows) so a range of frames can be read
+    without loading the rest.
+
+    Histograms of area, eccentricity and particles per frame are kept while
+    the positions are found, and saved beside them (*_HISTOGRAMS.npz) for
+    graph.py.
+"""
+
+import numpy as np
+from ast import literal_eval
+from os.path import getsize
+
+POS_DTYPE = np.dtype([('f', '<i4'), ('x', '<f8'), ('y', '<f8'),
+                      ('lab', '<i4'), ('ecc', '<f4'), ('area', '<i4')])
+CORNER_DTYPE = np.dtype(POS_DTYPE.descr + [('center', '<i4')])
+ORIENT_DTYPE = np.dtype(POS_DTYPE.descr + [('orient', '<f8')])
+INDEX_DTYPE = np.dtype([('f', '<i8'), ('start', '<i8'), ('count', '<i8')])
+
+HEADER_SIZE = 512
+ECC_BINS = 100      # bins of the eccentricity histogram on [0, 1]
+TEXT_FMT = ['%6d', '%7.3f', '%7.3f', '%4d', '%1.3f', '%5d']
+
+def text_header(kern, min_area, max_area, max_ecc, corner=False, orient=False):
+    """ the header lines of a positions text file """
+    return ('# Kern     Min area    Max area      Max eccen\n'
+            '#%5.2f%7d%13d%15.2f\n'
+            '#\n'
+            '# Frame    X           Y             Label  Eccen        Area%s%s\n'
+            ) % (kern, min_area, max_area, max_ecc, '     Center' if corner else '',
+                 '     Orient' if orient else '')
+
+def binary_name(output):
+    """ binary_name(output)
+        returns the binary file name for a text output name:
+        'prefix_POSITIONS.txt' becomes 'prefix_POSITIONS.bin'
+    """
+    return (output[:-4] if output.endswith('.txt') else output) + '.bin'
+
+def histogram_name(output):
+    """ histogram_name(output)
+        returns the histogram file name for an output name:
+        'prefix_POSITIONS.txt' (or .bin) becomes 'prefix_HISTOGRAMS.npz'
+    """
+    base = output[:-4] if output.endswith(('.txt', '.bin')) else output
+    if 'POSITIONS' in base:
+        return base.replace('POSITIONS', 'HISTOGRAMS') + '.npz'
+    return base + '_HISTOGRAMS.npz'
+
+def _add_counts(a, b):
+    """ sum of two bin counts of any lengths """
+    if len(a) < len(b):
+        a, b = b, a
+    a = a.copy()
+    a[:len(b)] += b
+    return a
+
+class Histograms(object):
+    """ Histograms()
+        Counts of the areas (one bin per pixel), the eccentricities (ECC_BINS
+        bins on [0, 1]) and the number of particles per frame, added to one
+        frame at a time so they cost nothing to keep while detecting.
+
+        add(pts) counts the pts found in a frame (with fields area and ecc);
+        merge(other) adds the counts of another, e.g. from another worker;
+        save(path) writes them as .npz, and load_histograms reads them.
+    """
+    def __init__(self):
+        self.area = np.zeros(0, int)
+        self.ecc = np.zeros(ECC_BINS, int)
+        self.count = np.zeros(0, int)
+
+    def __len__(self):
+        """ the number of frames counted """
+        return self.count.sum()
+
+    def add(self, pts):
+        area = np.asarray(pts['area']).astype(int).clip(0)
+        self.area = _add_counts(self.area, np.bincount(area))
+        ecc = (np.asarray(pts['ecc'])*ECC_BINS).astype(int).clip(0, ECC_BINS - 1)
+        self.ecc += np.bincount(ecc, minlength=ECC_BINS)
+        self.count = _add_counts(self.count, np.bincount([len(pts)]))
+
+    def merge(self, other):
+        self.area = _add_counts(self.area, other.area)
+        self.ecc += other.ecc
+        self.count = _add_counts(self.count, other.count)
+
+    def save(self, path):
+        np.savez(path, area=self.area, ecc=self.ecc, count=self.count)
+
+def load_histograms(path):
+    """ load_histograms(path) -> Histograms
+        reads histograms saved by Histograms.save
+    """
+    hists = Histograms()
+    saved = np.load(path)
+    hists.area, hists.ecc, hists.count = saved['area'], saved['ecc'], saved['count']
+    saved.close()
+    return hists
+
+class PositionsWriter(object):
+    """ PositionsWriter(path, kern, min_area, max_area, max_ecc, corner=False, binary=False, orient=False)
+        Appends positions to the output file one frame at a time, flushing
+        after each so a crash loses at most the frame being written.
+
+        write(frame, rows) takes rows as from positions.frame_rows, with the
+        owning center as a seventh column for corners, or the orientation
+        for centers if orient; nrows is the number of rows written so far.
+    """
+    def __init__(self, path, kern, min_area, max_area, max_ecc,
+                 corner=False, binary=False, orient=False):
+        self.path = path
+        self.binary = binary
+        self.corner = corner
+        self.nrows = 0
+        header = text_header(kern, min_area, max_area, max_ecc, corner, orient)
+        if binary:
+            self.dtype = CORNER_DTYPE if corner else ORIENT_DTYPE if orient else POS_DTYPE
+            header += '# dtype: {!r}\n'.format(self.dtype.descr)
+            if len(header) > HEADER_SIZE:
+                raise ValueError('header too long')
+            self.file = open(path, 'wb')
+            self.file.write(header.ljust(HEADER_SIZE - 1) + '\n')
+            self.index = open(path + '.idx', 'wb')
+        else:
+            self.file = open(path, 'w')
+            self.file.write(header)
+            self.fmt = TEXT_FMT + (['%6d'] if corner else []) + (['%7.4f'] if orient else [])
+        self.file.flush()
+
+    def write(self, frame, rows):
+        if self.binary:
+            recs = np.empty(len(rows), self.dtype)
+            for i, name in enumerate(self.dtype.names):
+                recs[name] = rows[:, i]
+            recs.tofile(self.file)
+            # the records go out before the index entry that points to them
+            self.file.flush()
+            np.array([(frame, self.nrows, len(rows))], INDEX_DTYPE).tofile(self.index)
+            self.index.flush()
+        else:
+            if len(rows):
+                np.savetxt(self.file, rows, delimiter='     ', fmt=self.fmt)
+            self.file.flush()
+        self.nrows += len(rows)
+
+    def close(self):
+        self.file.close()
+        if self.binary:
+            self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def read_header(path):
+    """ read_header(path) -> header text, dtype
+        reads the header of a binary positions file
+    """
+    with open(path, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+    for line in header.splitlines():
+        if line.startswith('# dtype:'):
+            dtype = np.dtype(literal_eval(line.split(':', 1)[1].strip()))
+            break
+    else:
+        raise ValueError('{} is not a binary positions file'.format(path))
+    return header.rstrip(), dtype
+
+def read_index(path):
+    """ read_index(path)
+        returns the (frame, start, count) index of a binary positions file,
+        ordered by frame
+    """
+    index = np.fromfile(path + '.idx', INDEX_DTYPE)
+    return index[np.argsort(index['f'], kind='mergesort')]
+
+def load_positions(path, frames=None):
+    """ load_positions(path, frames=None)
+        Loads a binary positions file as a structured array with fields
+        f, x, y, lab, ecc, area (and center, for corners, or orient) and id, the row
+        number in the file. The data are memory-mapped, so only the frames
+        asked for are read.
+
+        frames  - None for all frames, or (start, stop) to load frames
+                  start <= f < stop
+    """
+    header, dtype = read_header(path)
+    index = read_index(path)
+    # drop frames whose records did not all reach the file before a crash
+    nrecs = (getsize(path) - HEADER_SIZE)//dtype.itemsize
+    index = index[(index['count'] > 0) & (index['start'] + index['count'] <= nrecs)]
+    if frames is not None:
+        start, stop = frames
+        index = index[(index['f'] >= start) & (index['f'] < stop)]
+    nrows = (index['start'] + index['count']).max() if len(index) else 0
+    recs = np.memmap(path, dtype, 'r', offset=HEADER_SIZE, shape=(nrows,)) \
+            if nrows else np.empty(0, dtype)
+    rows = np.concatenate([np.arange(i['start'], i['start'] + i['count'])
+                           for i in index]) if len(index) else np.empty(0, int)
+    data = np.empty(len(rows), dtype.descr + [('id', int)])
+    for name in dtype.names:
+        data[name] = recs[name][rows]
+    data['id'] = rows
+    return data
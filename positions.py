@@ -1,8 +1,12 @@
 #!/usr/bin/env python
 
 import numpy as np
-from scipy.ndimage import gaussian_filter, median_filter, binary_erosion, convolve, center_of_mass, imread
-from skimage import measure, segmentation
+from scipy.ndimage import gaussian_filter, median_filter, maximum_filter, binary_erosion, binary_dilation, convolve, center_of_mass, imread
+from scipy.ndimage import label as ndlabel
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from skimage import segmentation
 from skimage.filter import canny
 from skimage.measure import label
 from skimage.morphology import square, binary_closing, skeletonize
@@ -11,8 +15,16 @@ from skimage.viewer import ImageViewer
 from collections import namedtuple
 from matplotlib import pyplot as plt
 import matplotlib.cm
+from os import path
+from posfile import Histograms
 
 DIST_THRESH = 100.
+# working precision of the images (see load_image) for --precision; in
+# single precision positions agree with double to within 1e-3 pixel, though
+# pixels within 1e-6 of a threshold may join or leave a segment
+PRECISION = {'double': np.float64, 'single': np.float32}
+FFT_CSIZE = 3       # convolve by fft for kernels larger than this
+FFT_BLOCK = 1024    # overlap-add in blocks for images at least twice this
 
 def label_particles_edge(im, sigma=2, closing_size=0, **extra_args):
     """ label_particles_edge(image, sigma=3, closing_size=3)
@@ -33,7 +45,8 @@ def label_particles_edge(im, sigma=2, closing_size=0, **extra_args):
     labels = np.ma.array(labels, mask=edges==0) # in ma.array mask, False is True, and vice versa
     return labels
 
-def label_particles_walker(im, min_thresh=0.3, max_thresh=0.5, sigma=3):
+def label_particles_walker(im, min_thresh=0.3, max_thresh=0.5, sigma=3,
+                           scale=1, band=2, tol=1e-3, **extra_args):
     """ label_particles_walker(image, min_thresh=0.3, max_thresh=0.5)
         Returns the labels for an image.
         Segments using random_walker method.
@@ -42,106 +55,379 @@ def label_particles_walker(im, min_thresh=0.3, max_thresh=0.5, sigma=3):
         image        -- The image in which to find particles
         min_thresh   -- The lower limit for binary threshold
         max_thresh   -- The upper limit for binary threshold
+        scale        -- If more than 1, solve first on the image reduced by
+                        scale, then again at full size only within band
+                        (coarse) pixels of the boundaries found
+        tol          -- Tolerance of the conjugate gradient solver
+
+        The dark pixels (below min_thresh) seed the particles, the bright
+        (above max_thresh) the background; each connected region walked to
+        by the particle seeds gets a label.
     """
     if sigma>0:
         im = gaussian_filter(im, sigma)
-    labels = np.zeros_like(im)
-    labels[im<min_thresh*im.max()] = 1
-    labels[im>max_thresh*im.max()] = 2
-    return segmentation.random_walker(im, labels)
+    seeds = np.zeros(im.shape, int)
+    seeds[im<min_thresh*im.max()] = 1
+    seeds[im>max_thresh*im.max()] = 2
+    if scale > 1:
+        h, w = im.shape[0]//scale, im.shape[1]//scale
+        coarse = im[:h*scale, :w*scale].reshape(h, scale, w, scale).mean(3).mean(1)
+        cseeds = np.zeros(coarse.shape, int)
+        cseeds[coarse<min_thresh*im.max()] = 1
+        cseeds[coarse>max_thresh*im.max()] = 2
+        prob = segmentation.random_walker(coarse, cseeds, mode='cg', tol=tol,
+                                          return_full_prob=True)[0]
+        # upsample, repeating the last row and column for the remainders
+        rows = np.minimum(np.arange(im.shape[0])//scale, h - 1)
+        cols = np.minimum(np.arange(im.shape[1])//scale, w - 1)
+        walked = np.where(prob[rows[:, None], cols] >= .5, 1, 2)
+        inside = walked == 1
+        edge = inside ^ binary_erosion(inside, border_value=1)
+        fixed = ~binary_dilation(edge, iterations=band*scale)
+        seeds[fixed & (seeds == 0)] = walked[fixed & (seeds == 0)]
+        if not (seeds == 0).any():
+            return label(seeds == 1)
+    walked = segmentation.random_walker(im, seeds, mode='cg', tol=tol)
+    return label(walked == 1)
 
-def label_particles_convolve(im, thresh=3, rmv=None, csize=0, **extra_args):
-    """ label_particles_convolve(im, thresh=2)
-        Returns the labels for an image
-        Segments using a threshold after convolution with proper gaussian kernel
-        Uses center of mass from original image to find centroid of segments
-
-        Input:
-            image   the original image
-            pos     if given, the positions at which to remove large dots
-            thresh  the threshold above which pixels are included
+def convolve_thresh(im, thresh=3, rmv=None, csize=0, fft=None, spectrum=None):
+    """ convolve_thresh(im, thresh=3, rmv=None, csize=0) -> convolved, thresh, lo, hi
+        Convolves the image with the kernel for csize and normalizes the
+        result to [0, 1], as convolved = (raw - lo)/hi; an integer thresh
+        is taken as a number of standard deviations above the mean, and
+        returned as a value in those units. Arguments are as for
+        label_particles_convolve.
     """
-    from matplotlib import pyplot as plt
-    #plt.hist(im.flatten(), bins=100)
-    #plt.show()
     if csize == 0:
         raise ValueError('csize not set')
-    elif csize < 0:
-        #print "negative kernel"
-        convolved = convolve(im, -gdisk(-csize))
+    if fft is None:
+        fft = spectrum is not None or abs(csize) > FFT_CSIZE
+    if fft:
+        convolved = fft_convolve(im, csize, spectrum)
     else:
-        #print "positive kernel"
-        convolved = convolve(im, gdisk(csize))
+        convolved = convolve(im, kernel(csize))
 
     if rmv is not None:
-        convolved = remove_disks(convolved, rmv[0], disk(rmv[1]))
+        convolved = remove_disks(convolved, rmv[0], disk(rmv[1]), inplace=True)
 
     #convolved[convolved < 0.] = 0.
-    convolved -= convolved.min()
-    convolved /= convolved.max()
+    lo = convolved.min()
+    convolved -= lo
+    hi = convolved.max()
+    convolved /= hi
 
     if isinstance(thresh, int):
         if rmv is not None:
             thresh -= 1 # smaller threshold for corners
         thresh = convolved.mean() + thresh*convolved.std()
+    return convolved, thresh, lo, hi
+
+def label_particles_convolve(im, thresh=3, rmv=None, csize=0, fft=None,
+                             spectrum=None, return_thresh=False, **extra_args):
+    """ label_particles_convolve(im, thresh=2)
+        Returns the labels for an image
+        Segments using a threshold after convolution with proper gaussian kernel
+        Uses center of mass from original image to find centroid of segments
+
+        Input:
+            image   the original image
+            pos     if given, the positions at which to remove large dots
+            thresh  the threshold above which pixels are included
+            fft     convolve by fft; default (None) uses fft for kernels
+                    with |csize| > FFT_CSIZE
+            spectrum  precomputed image_spectrum of image, implies fft
+            return_thresh  also return the threshold in units of the raw
+                    (unnormalized) convolution, for find_particles_windowed
+    """
+    from matplotlib import pyplot as plt
+    #plt.hist(im.flatten(), bins=100)
+    #plt.show()
+    convolved, thresh, lo, hi = convolve_thresh(im, thresh, rmv, csize, fft, spectrum)
 
     labels = label(convolved > thresh)
     
     #print "found {} segments above thresh".format(labels.max())
+    if return_thresh:
+        return labels, convolved, lo + thresh*hi
     return labels, convolved
 
 Segment = namedtuple('Segment', 'x y label ecc area'.split())
+SEGMENT_DTYPE = np.dtype([('x', float), ('y', float), ('label', int),
+                          ('ecc', float), ('area', int)])
 
-def filter_segments(labels, max_ecc=0.5, min_area=15, max_area=200, intensity=None, **extra_args):
-    """ filter_segments(labels, max_ecc=0.5, min_area=15, max_area=200) -> [Segment]
-        Returns a list of Particles and masks out labels for
-        particles not meeting acceptance criteria.
-    """
-    pts = []
-    centroid = 'Centroid' if intensity is None else 'WeightedCentroid'
-    #rprops = measure.regionprops(labels, ['Area', 'Eccentricity', centroid], intensity)
-    rprops = measure.regionprops(labels, intensity)
-    for props in rprops:
-        label = props['Label']
-        area = props['Area']
-        ecc = props['Eccentricity']
-        if min_area > area:
-            #print 'too small:', area
-            pass
-        elif area > max_area:
-            #print 'too big:', area
-            pass
-        elif ecc > max_ecc:
-            #print 'too eccentric:', ecc
-            #labels[labels==label] = np.ma.masked
-            pass
-        else:
-            x, y = props[centroid]
-            pts.append(Segment(x, y, label, ecc, area))
+def segment_stats(labels, intensity=None):
+    """ segment_stats(labels, intensity=None) -> array of SEGMENT_DTYPE
+        Returns centroid, label, eccentricity and area for every labeled
+        region at once, from bincount reductions over the labeled pixels.
+        If intensity is given, the centroid is weighted by it.
+    """
+    labels = np.ma.filled(labels, 0)
+    fg = np.flatnonzero(labels)
+    lab = labels.ravel()[fg]
+    r, c = np.divmod(fg, labels.shape[1])
+    area = np.bincount(lab)
+    labs = np.flatnonzero(area[1:]) + 1
+    idx = np.searchsorted(labs, lab)
+    n = area[labs].astype(float)
+
+    # second central moments give the eccentricity, as in regionprops
+    xc = np.bincount(idx, r)/n
+    yc = np.bincount(idx, c)/n
+    dr, dc = r - xc[idx], c - yc[idx]
+    mrr = np.bincount(idx, dr*dr)/n
+    mcc = np.bincount(idx, dc*dc)/n
+    mrc = np.bincount(idx, dr*dc)/n
+    half = np.hypot((mrr - mcc)/2, mrc)
+    l1, l2 = (mrr + mcc)/2 + half, (mrr + mcc)/2 - half
+    ecc = np.zeros_like(l1)
+    nz = l1 > 0
+    ecc[nz] = np.sqrt(1 - l2[nz]/l1[nz])
+
+    if intensity is not None:
+        w = intensity.ravel()[fg]
+        wsum = np.bincount(idx, w)
+        xc = np.bincount(idx, w*r)/wsum
+        yc = np.bincount(idx, w*c)/wsum
+
+    pts = np.empty(len(labs), SEGMENT_DTYPE)
+    pts['x'], pts['y'] = xc, yc
+    pts['label'], pts['ecc'], pts['area'] = labs, ecc, area[labs]
     return pts
 
-def find_particles(imfile, method='edge', return_image=False, **kwargs):
-    """ find_particles(imfile, gaussian_size=3, **kwargs) -> [Segment],labels
-        Find the particles in image im. The arguments in kwargs is
-        passed to label_particles and filter_segments.
+def filter_segments(labels, max_ecc=0.5, min_area=15, max_area=200, intensity=None, **extra_args):
+    """ filter_segments(labels, max_ecc=0.5, min_area=15, max_area=200) -> pts
+        Returns an array (of SEGMENT_DTYPE, see segment_stats) of the
+        particles meeting acceptance criteria.
+    """
+    pts = segment_stats(labels, intensity)
+    keep = (pts['area'] >= min_area) & (pts['area'] <= max_area) \
+         & (pts['ecc'] <= max_ecc)
+    return pts[keep]
+
+def find_peaks(im, thresh=3, rmv=None, csize=0, fft=None, spectrum=None,
+               return_thresh=False, max_ecc=0.5, min_area=15, max_area=200,
+               **extra_args):
+    """ find_peaks(im, thresh=3, rmv=None, csize=0, ...) -> pts, labels, convolved
+        Finds particles as the local maxima of the convolved image (as by
+        convolve_thresh) above thresh, without labeling any regions. A peak
+        must be the largest value within the radius of a particle, taken
+        from max_area (or csize, if max_area is not finite).
+
+        Each peak is measured over the pixels above thresh in a disk around
+        it as wide as that radius (and at least |csize|): its position is
+        their centroid weighted by 1 - im, as for 'convolve', and its area
+        and eccentricity are those of the pixels, as by segment_stats. The
+        label is the index of the peak, and labels marks each peak's pixel
+        with it.
+
+        Returns pts, meeting the same criteria as filter_segments, labels,
+        convolved, and the raw threshold if return_thresh.
+    """
+    convolved, thresh, lo, hi = convolve_thresh(im, thresh, rmv, csize, fft, spectrum)
+    r = np.sqrt(max_area/np.pi) if np.isfinite(max_area) else abs(csize)
+    foot = disk(max(int(round(r)), 1))
+    peak = convolved == maximum_filter(convolved, footprint=foot, mode='nearest')
+    peak &= convolved > thresh
+    x, y = np.nonzero(peak)
+
+    # moments of the pixels above thresh in the window of each peak
+    window = disk(max(int(round(r)), int(np.ceil(abs(csize))), 1))
+    ox, oy = np.nonzero(window)
+    ox -= window.shape[0]//2
+    oy -= window.shape[1]//2
+    intensity = 1 - im
+    n, sx, sy, sxx, syy, sxy = np.zeros((6, len(x)))
+    w, wx, wy = np.zeros((3, len(x)))
+    for i in xrange(len(ox)):
+        xi, yi = x + ox[i], y + oy[i]
+        inside = (xi >= 0) & (xi < im.shape[0]) & (yi >= 0) & (yi < im.shape[1])
+        xi, yi = xi.clip(0, im.shape[0] - 1), yi.clip(0, im.shape[1] - 1)
+        above = inside & (convolved[xi, yi] > thresh)
+        n += above
+        sx += above*ox[i]
+        sy += above*oy[i]
+        sxx += above*ox[i]*ox[i]
+        syy += above*oy[i]*oy[i]
+        sxy += above*ox[i]*oy[i]
+        wi = above*intensity[xi, yi]
+        w += wi
+        wx += wi*ox[i]
+        wy += wi*oy[i]
+    # the peak itself is above thresh, so n > 0
+    mx, my = sx/n, sy/n
+    mrr, mcc, mrc = sxx/n - mx*mx, syy/n - my*my, sxy/n - mx*my
+    half = np.hypot((mrr - mcc)/2, mrc)
+    l1, l2 = (mrr + mcc)/2 + half, (mrr + mcc)/2 - half
+    ecc = np.zeros_like(l1)
+    nz = l1 > 0
+    ecc[nz] = np.sqrt(1 - (l2[nz]/l1[nz]).clip(0, 1))
+    weighted = w > 0
+    dx = np.where(weighted, wx/np.where(weighted, w, 1), mx)
+    dy = np.where(weighted, wy/np.where(weighted, w, 1), my)
+
+    pts = np.empty(len(x), SEGMENT_DTYPE)
+    pts['x'], pts['y'] = x + dx, y + dy
+    pts['label'], pts['ecc'], pts['area'] = np.arange(1, len(x) + 1), ecc, n
+    labels = np.zeros(im.shape, int)
+    labels[x, y] = pts['label']
+
+    keep = (n >= min_area) & (n <= max_area) & (ecc <= max_ecc)
+    out = pts[keep], labels, convolved
+    if return_thresh:
+        return out + (lo + thresh*hi,)
+    return out
+
+def traced_perimeter(labels):
+    """ traced_perimeter(labels) -> perimeter of each label, indexed by label
+        The length of the outline of each 8-connected region, as ImageJ's
+        Analyze Particles traces it: the pixel edges of the outline, less
+        2 - sqrt(2) for each of its corners, where along a staircase of unit
+        steps only every other corner counts. Computed for all regions at
+        once from the 2x2 neighborhoods of the outline's vertices; holes
+        add their outlines too, which ImageJ leaves out.
+    """
+    lab = np.pad(labels, 1, mode='constant')
+    n = lab.max() + 1
+    # outline edges, and the vertices at either end of each
+    hedge = (lab[1:, 1:-1] > 0) != (lab[:-1, 1:-1] > 0)
+    vedge = (lab[1:-1, 1:] > 0) != (lab[1:-1, :-1] > 0)
+    hlab = np.maximum(lab[1:, 1:-1], lab[:-1, 1:-1])
+    vlab = np.maximum(lab[1:-1, 1:], lab[1:-1, :-1])
+    edges = np.bincount(hlab[hedge], minlength=n) + np.bincount(vlab[vedge], minlength=n)
+
+    # a vertex is a corner if its 2x2 neighborhood has one or three pixels
+    # of a region in it, and a double corner if two diagonal ones
+    w = lab[:-1, :-1], lab[:-1, 1:], lab[1:, :-1], lab[1:, 1:]
+    count = (w[0] > 0).astype(int) + (w[1] > 0) + (w[2] > 0) + (w[3] > 0)
+    vlabel = np.maximum.reduce(w)
+    diag = (count == 2) & ((w[0] > 0) == (w[3] > 0))
+    turns = (count % 2) + 2*diag
+    nturns = np.bincount(vlabel.ravel(), turns.ravel(), minlength=n)
+
+    # unit sides are edges between two corners; of a chain of k of them,
+    # only k//2 of the corners they lead to count (k/2 if they close a loop)
+    hunit = hedge & (turns[:, :-1] > 0) & (turns[:, 1:] > 0)
+    vunit = vedge & (turns[:-1] > 0) & (turns[1:] > 0)
+    ids = np.arange(turns.size).reshape(turns.shape)
+    a = np.concatenate((ids[:, :-1][hunit], ids[:-1][vunit]))
+    b = np.concatenate((ids[:, 1:][hunit], ids[1:][vunit]))
+    nunit = np.bincount(hlab[hunit], minlength=n) + np.bincount(vlab[vunit], minlength=n)
+    graph = coo_matrix((np.ones(len(a)), (a, b)), shape=(turns.size,)*2)
+    chain = connected_components(graph, directed=False)[1]
+    k = np.bincount(chain[a], minlength=chain.max() + 1)
+    loop = k == np.bincount(chain)
+    skipped = np.where(loop, k/2., k - k//2)
+    clabel = np.zeros(len(k), int)
+    clabel[chain] = vlabel.ravel()
+    skipped = np.bincount(clabel, skipped, minlength=n)
+    # each side leads to one corner
+    corners = nturns - skipped
+    return edges - corners*(2 - np.sqrt(2))
+
+def find_brights(frame, low=101, high=255, min_area=50, max_area=300,
+                 min_circ=0.5, max_circ=1, roi=None, **extra_args):
+    """ find_brights(frame, low=101, high=255, min_area=50, max_area=300,
+                     min_circ=0.5, max_circ=1, roi=None) -> pts, labels
+        Finds the bright spots in the raw frame as find_brights.imj does in
+        ImageJ: the pixels outside the circle roi = (x, y, r) are cleared,
+        those between low and high (inclusive) are taken, and the 8-connected
+        regions with area between min_area and max_area and circularity
+        4*pi*area/perimeter**2 (at most 1, see traced_perimeter) between
+        min_circ and max_circ are kept. Color frames are averaged over
+        channels, as ImageJ converts them to 8-bit.
 
-        Returns the list of found particles and the label image.
+        Returns an array of SEGMENT_DTYPE, as filter_segments, with the
+        unweighted centroids, and the label image.
     """
-    if args.verbose: print "opening", imfile
-    im = imread(imfile).astype(float)
-    if imfile.lower().endswith('tif'):
-        # clean pixel noise from phantom images
-        pass #im = median_filter(im, size=2)
-    elif imfile.lower().endswith('jpg') and im.ndim == 3:
-        # use just the green channel from color slr images
-        im = im[..., 1]
+    if frame.ndim == 3:
+        frame = frame.mean(2)
+    mask = (frame >= low) & (frame <= high)
+    if roi is not None:
+        x, y, r = roi
+        rows, cols = np.ogrid[:frame.shape[0], :frame.shape[1]]
+        mask &= (rows - x)**2 + (cols - y)**2 <= r**2
+    labels = ndlabel(mask, np.ones((3, 3), int))[0]
+    pts = segment_stats(labels)
+    perim = traced_perimeter(labels)[pts['label']]
+    circ = np.minimum(4*np.pi*pts['area']/np.maximum(perim, 1)**2, 1)
+    keep = (pts['area'] >= min_area) & (pts['area'] <= max_area) \
+         & (circ >= min_circ) & (circ <= max_circ)
+    return pts[keep], labels
+
+def frame_rows(n, pts, offset=(0, 0)):
+    """ frame_rows(n, pts, offset=(0, 0))
+        returns pts as rows of frame, x, y, label, ecc, area for output,
+        with offset added to x, y for pts found in a cropped image
+    """
+    rows = np.column_stack([np.full(len(pts), n)] +
+                           [pts[name] for name in pts.dtype.names])
+    rows[:, 1:3] += offset
+    return rows
+
+def load_image(imfile, dtype=float, background=None):
+    """ load_image(imfile, dtype=float, background=None) -> image
+        Reads the image file and normalizes it for find_particles:
+        dark pixels are cut, bright pixels clipped at the mean,
+        and the result is scaled to a maximum of one.
+        imfile may also be a raw frame, as from a frames.py source.
+
+        The raw data are kept as read (e.g., uint8 or uint16) until the
+        channel is chosen, then copied once to dtype and normalized in
+        place; see PRECISION for using float32. If a background.Background
+        is given, it is updated with the frame, which it then flat-fields.
+    """
+    if isinstance(imfile, basestring):
+        if args.verbose: print "opening", imfile
+        im = imread(imfile)
+        if imfile.lower().endswith('tif'):
+            # clean pixel noise from phantom images
+            pass #im = median_filter(im, size=2)
+        elif imfile.lower().endswith('jpg') and im.ndim == 3:
+            # use just the green channel from color slr images
+            im = im[..., 1]
+    else:
+        im = imfile
+        if im.ndim == 3:
+            im = im[..., 1]
+    if background is not None:
+        background.update(im)
+    im = np.array(im, dtype)
+    if background is not None:
+        background.flatfield(im)
     im[im < im.mean() - 2*im.std()] = 0.
     #im = gaussian_filter(im, 1)
     x = im.mean()# + im.std()
     im[im > x] = x
     im /= im.max()
+    return im
+
+def find_particles(imfile, method='edge', return_image=False, tile=0,
+                   return_thresh=False, return_labels=True, **kwargs):
+    """ find_particles(imfile, gaussian_size=3, **kwargs) -> [Segment],labels
+        Find the particles in image im. The arguments in kwargs is
+        passed to label_particles and filter_segments.
+        imfile may be a filename, or an image already given by load_image.
+        If tile is given, the 'convolve' method works on tiles of that
+        size, see find_particles_tiled; then the label image is None
+        unless return_labels. The 'peaks' method takes local
+        maxima of the convolution instead of labeling, see find_peaks.
+
+        Returns the list of found particles and the label image, then the
+        convolved image if return_image, then the raw threshold if
+        return_thresh (for the 'convolve' and 'peaks' methods).
+    """
+    im = load_image(imfile) if isinstance(imfile, basestring) else imfile
+
+    if method == 'convolve' and tile:
+        return find_particles_tiled(im, tile, return_image=return_image,
+                                    return_labels=return_labels, **kwargs)
 
     intensity = None
+    convolved = im
+
+    if method == 'peaks':
+        out = find_peaks(im, return_thresh=return_thresh, **kwargs)
+        return out[:2] + ((out[2],) if return_image else ()) + out[3:]
 
     #print "Seeking particles using", method
     if method == 'walker':
@@ -149,12 +435,268 @@ def find_particles(imfile, method='edge', return_image=False, **kwargs):
     elif method == 'edge':
         labels = label_particles_edge(im, **kwargs)
     elif method == 'convolve':
-        labels, convolved = label_particles_convolve(im, **kwargs)
+        out = label_particles_convolve(im, return_thresh=return_thresh, **kwargs)
+        labels, convolved = out[:2]
         intensity = 1 - im
     else:
         raise RuntimeError('Undefined method "%s"' % method)
 
     pts = filter_segments(labels, intensity=intensity, **kwargs)
+    return (pts, labels) + ((convolved,) if return_image else ()) \
+                         + ((out[2],) if return_thresh else ())
+
+def _reflect(i, n):
+    """ indices i into an axis of length n, reflected at the ends as by
+        ndimage's 'reflect' mode (for i within n of the ends)
+    """
+    i = np.where(i < 0, -i - 1, i)
+    return np.where(i >= n, 2*n - i - 1, i)
+
+def window_convolve(stack, csize, chunk=256):
+    """ window_convolve(stack, csize, chunk=256)
+        Convolves each window of the stack (windows along the first axis)
+        with kernel(csize) by fft, chunk windows at a time, keeping only
+        the valid part, where the kernel lies wholly in the window; the
+        same as convolve(stack, kernel(csize)[None])[:, w:-w, w:-w] for the
+        kernel half-width w, in the dtype of the stack.
+    """
+    w = kernel(csize).shape[0]//2
+    side = stack.shape[1]
+    fshape = (fast_len(side),)*2
+    kspec = kernel_spectrum(csize, fshape)
+    conv = np.empty((len(stack), side - 2*w, side - 2*w), stack.dtype)
+    for i in xrange(0, len(stack), chunk):
+        spec = np.fft.rfft2(stack[i:i+chunk], fshape, axes=(1, 2))
+        # the kernel is symmetric, and the wrapped part of the circular
+        # convolution falls outside the valid region
+        conv[i:i+chunk] = np.fft.irfft2(spec*kspec, fshape, axes=(1, 2))[:, 2*w:side, 2*w:side]
+    return conv
+
+def find_particles_windowed(im, prev, raw_thresh=None, csize=0, search=5, nearest=True,
+                            rmv=None, max_ecc=0.5, min_area=15, max_area=200,
+                            rel_thresh=0.5, **extra_args):
+    """ find_particles_windowed(im, prev, raw_thresh, csize, search=5) -> pts
+        Finds particles only in small windows of the image around the
+        positions prev (array with 'x' and 'y' fields), using a threshold
+        raw_thresh in units of the raw convolution, as given by
+        label_particles_convolve(..., return_thresh=True) for an earlier
+        full frame. The windows of all particles are stacked and convolved
+        together by fft (window_convolve), and each window reaches search pixels (plus the size of a
+        particle) beyond its center, with values equal to those of the full
+        convolution. If raw_thresh is None, each window is thresholded at
+        rel_thresh times its own maximum instead.
+
+        nearest:    keep only the particle nearest the window center, within
+                    search, for each window (centers in consecutive frames);
+                    otherwise keep all particles found (e.g., corner dots
+                    around their centers)
+        rmv:        (pts, r) as in label_particles_convolve, the positions at
+                    which to remove disks of radius r from the convolution
+
+        Returns an array of SEGMENT_DTYPE, as filter_segments, with
+        particles found in more than one window given once.
+    """
+    if not len(prev):
+        return np.empty(0, SEGMENT_DTYPE)
+    w = kernel(csize).shape[0]//2
+    size = int(search + (np.sqrt(max_area/np.pi) if np.isfinite(max_area) else w))
+    half = w + size
+    xs = np.round(prev['x']).astype(int)
+    ys = np.round(prev['y']).astype(int)
+    offsets = np.arange(-half, half + 1)
+    rows = _reflect(xs[:, None] + offsets, im.shape[0])
+    cols = _reflect(ys[:, None] + offsets, im.shape[1])
+    stack = im[rows[:, :, None], cols[:, None, :]]
+    conv = window_convolve(stack, csize)
+    intensity = 1 - stack[:, w:-w, w:-w]
+    origins = np.column_stack((xs - size, ys - size))
+
+    nwin, side = conv.shape[:2]
+    if rmv is not None:
+        # stamp the disks of every rmv particle that reaches into each window
+        rpts, r = rmv
+        dsk = disk(r)
+        rxy = np.column_stack((np.round(rpts['x']), np.round(rpts['y']))).astype(int)
+        near = cKDTree(origins + size).query_ball_point(rxy, (size + r)*np.sqrt(2))
+        pairs = np.array([(k, j) for j, ks in enumerate(near) for k in ks], int).reshape(-1, 2)
+        dx, dy = np.nonzero(dsk)
+        lx = rxy[pairs[:, 1], 0, None] - origins[pairs[:, 0], 0, None] + dx - dsk.shape[0]//2
+        ly = rxy[pairs[:, 1], 1, None] - origins[pairs[:, 0], 1, None] + dy - dsk.shape[1]//2
+        ks = np.repeat(pairs[:, 0], len(dx))
+        lx, ly = lx.ravel(), ly.ravel()
+        inside = (lx >= 0) & (lx < side) & (ly >= 0) & (ly < side)
+        conv[ks[inside], lx[inside], ly[inside]] = 0
+
+    # no connections between windows: label them as one tall image
+    structure = np.zeros((3, 3, 3), int)
+    structure[1] = 1
+    if raw_thresh is None:
+        raw_thresh = rel_thresh*conv.max(2).max(1)[:, None, None]
+    labels = ndlabel(conv > raw_thresh, structure)[0]
+    pts = filter_segments(labels.reshape(nwin*side, side), max_ecc, min_area,
+                          max_area, intensity.reshape(nwin*side, side))
+    k = (pts['x'] // side).astype(int)
+    pts['x'] += origins[k, 0] - k*side
+    pts['y'] += origins[k, 1]
+
+    if nearest:
+        dist = np.hypot(pts['x'] - prev['x'][k], pts['y'] - prev['y'][k])
+        order = np.lexsort((dist, k))
+        first = np.ones(len(order), bool)
+        first[1:] = k[order][1:] != k[order][:-1]
+        order = order[first]
+        order = order[dist[order] < search]
+        pts = pts[np.sort(order)]
+
+    # the same particle may be found in overlapping windows
+    if len(pts) < 2:
+        return pts
+    tree = cKDTree(np.column_stack((pts['x'], pts['y'])))
+    dups = [max(pair) for pair in tree.query_pairs(1.)]
+    return np.delete(pts, dups)
+
+def block_mean(im, scale):
+    """ block_mean(im, scale)
+        the mean of each scale x scale square of the image, dropping the
+        remainder rows and columns
+    """
+    h, w = im.shape[0]//scale, im.shape[1]//scale
+    return im[:h*scale, :w*scale].reshape(h, scale, w, scale).mean(3).mean(1)
+
+def load_coarse(frame, scale=4, dtype=float):
+    """ load_coarse(frame, scale=4, dtype=float) -> image
+        Reduces the raw frame (as read, before load_image) by block
+        averaging scale x scale squares, normalized by load_image; the
+        frame already read for the full image serves, so it is decoded
+        only once.
+    """
+    if frame.ndim == 3:
+        frame = frame[..., 1]
+    return load_image(block_mean(frame, scale), dtype)
+
+def find_particles_multires(im, coarse, scale, offset=(0, 0), csize=0,
+                            max_ecc=0.5, min_area=15, max_area=200, **kwargs):
+    """ find_particles_multires(im, coarse, scale, csize, ...) -> pts
+        Finds particles in the image coarse, reduced by scale from im (as
+        from load_coarse), with the kernel and areas scaled down to match,
+        then refines each in a small window of the full image with
+        find_particles_windowed; the full image is never convolved as a
+        whole. For im cropped at offset from the full frame, particles
+        found outside it are dropped.
+
+        Returns an array of SEGMENT_DTYPE, as filter_segments, in the
+        coordinates of im.
+    """
+    # keep the coarse kernel width (4*csize + 1) whole
+    ccsize = np.round(2.*csize/scale)/2 or np.sign(csize)*.5
+    labels = label_particles_convolve(coarse, csize=ccsize, **kwargs)[0]
+    cpts = filter_segments(labels, min_area=min_area/float(scale)**2,
+                           max_area=max_area/float(scale)**2,
+                           max_ecc=max_ecc, intensity=1 - coarse)
+    cpts['x'] = (cpts['x'] + .5)*scale - .5 - offset[0]
+    cpts['y'] = (cpts['y'] + .5)*scale - .5 - offset[1]
+    cpts = cpts[(cpts['x'] >= 0) & (cpts['x'] < im.shape[0]) &
+                (cpts['y'] >= 0) & (cpts['y'] < im.shape[1])]
+    return find_particles_windowed(im, cpts, csize=csize, search=scale,
+                                   max_ecc=max_ecc, min_area=min_area,
+                                   max_area=max_area)
+
+def tile_slices(shape, tile, halo):
+    """ tile_slices(shape, tile, halo)
+        yields (core, window) pairs of slices covering an image of shape
+        with square tiles of side tile; the windows extend each core by
+        halo on all sides, clipped at the image edges
+    """
+    for i in xrange(0, shape[0], tile):
+        for j in xrange(0, shape[1], tile):
+            core = (slice(i, min(i + tile, shape[0])),
+                    slice(j, min(j + tile, shape[1])))
+            window = (slice(max(i - halo, 0), min(i + tile + halo, shape[0])),
+                      slice(max(j - halo, 0), min(j + tile + halo, shape[1])))
+            yield core, window
+
+def find_particles_tiled(im, tile=512, nthreads=4, thresh=3, rmv=None, csize=0,
+                         return_image=False, return_labels=True, **kwargs):
+    """ find_particles_tiled(im, tile=512, nthreads=4, **kwargs) -> pts, labels
+        Same as find_particles(im, method='convolve', ...) but convolves,
+        labels and measures the image in tiles, on a pool of nthreads
+        threads. Beyond the image itself, only the convolution is kept at
+        full size, in float32; everything else is made a tile at a time.
+
+        Each tile is convolved with a halo as wide as the kernel, and
+        labeled with a halo as wide as the largest particle (from max_area);
+        particles are kept by the tile whose core holds their centroid, so
+        those on the seams are found once. The threshold comes from sums
+        over the tiles, in float64, and is applied in units of the raw
+        convolution, which is normalized (as by convolve_thresh) only if
+        return_image. The full label image is only made if return_labels;
+        otherwise labels is None.
+    """
+    from multiprocessing.pool import ThreadPool
+    if csize == 0:
+        raise ValueError('csize not set')
+    kern = kernel(csize)
+    w = kern.shape[0]//2
+    max_area = kwargs.get('max_area', np.inf)
+    halo = int(2*np.sqrt(max_area/np.pi)) + 2 if np.isfinite(max_area) else w
+    pool = ThreadPool(nthreads)
+
+    def core_of(core, window):
+        return tuple(slice(c.start - win.start, c.stop - win.start)
+                     for c, win in zip(core, window))
+
+    convolved = np.empty(im.shape, np.float32)
+    def convolve_tile((core, window)):
+        if abs(csize) > FFT_CSIZE:
+            conv = fft_convolve(im[window], csize)
+        else:
+            conv = convolve(im[window], kern)
+        convolved[core] = conv[core_of(core, window)]
+    pool.map(convolve_tile, tile_slices(im.shape, tile, w))
+
+    if rmv is not None:
+        remove_disks(convolved, rmv[0], disk(rmv[1]), inplace=True)
+
+    def stats_tile((core, window)):
+        c = convolved[core].astype(float)
+        return c.min(), c.max(), c.sum(), (c*c).sum()
+    stats = np.array(pool.map(stats_tile, tile_slices(im.shape, tile, 0)))
+    lo, hi = stats[:, 0].min(), stats[:, 1].max()
+    hi -= lo
+    if isinstance(thresh, int):
+        if rmv is not None:
+            thresh -= 1 # smaller threshold for corners
+        mean = stats[:, 2].sum()/convolved.size
+        std = np.sqrt(max(stats[:, 3].sum()/convolved.size - mean*mean, 0))
+        thresh = (mean - lo)/hi + thresh*std/hi
+    raw_thresh = lo + thresh*hi
+
+    def label_tile((core, window)):
+        labels = label(convolved[window] > raw_thresh)
+        pts = filter_segments(labels, intensity=1 - im[window], **kwargs)
+        pts['x'] += window[0].start
+        pts['y'] += window[1].start
+        incore = (pts['x'] >= core[0].start) & (pts['x'] < core[0].stop) \
+               & (pts['y'] >= core[1].start) & (pts['y'] < core[1].stop)
+        tlabels = labels[core_of(core, window)].astype(np.int32) if return_labels else None
+        return core, tlabels, labels.max(), pts[incore]
+    tiles = pool.map(label_tile, tile_slices(im.shape, tile, halo))
+    pool.close()
+
+    # give labels unique across tiles
+    labels = np.zeros(im.shape, np.int32) if return_labels else None
+    allpts = []
+    offset = 0
+    for core, tlabels, nlabels, pts in tiles:
+        if return_labels:
+            labels[core] = np.where(tlabels > 0, tlabels + offset, 0)
+        pts['label'] += offset
+        allpts.append(pts)
+        offset += nlabels
+    pts = np.concatenate(allpts)
+    if return_image:
+        convolved -= lo
+        convolved /= hi
     return (pts, labels) + ((convolved,) if return_image else ())
 
 def disk(n):
@@ -176,55 +718,603 @@ def gdisk(n, w=None):
     assert np.allclose(g.sum(),0), 'sum is nonzero: {}'.format(g.sum())
     return g
 
+_kernels = {}
+
+def kernel(csize):
+    """ kernel(csize)
+        return the (cached) convolution kernel for csize:
+        gdisk(csize) if csize is positive, -gdisk(-csize) if negative
+    """
+    try:
+        return _kernels[csize]
+    except KeyError:
+        kern = _kernels[csize] = gdisk(csize) if csize > 0 else -gdisk(-csize)
+        return kern
+
+def fast_len(n):
+    """ fast_len(n):
+        return the smallest 5-smooth integer >= n, a fast size for fft
+    """
+    best = 2**int(np.ceil(np.log2(n)))
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            p = p35
+            while p < n:
+                p *= 2
+            best = min(best, p)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+Spectrum = namedtuple('Spectrum', 'shape pad block fshape blocks dtype'.split())
+
+def image_spectrum(im, pad, block=None):
+    """ image_spectrum(im, pad, block=None) -> Spectrum
+        Reflect-pads the image by pad and takes the fft of each block,
+        for use by fft_convolve with any kernel no wider than 2*pad+1.
+        Images with a side of at least 2*FFT_BLOCK are split into equal
+        blocks to be convolved by overlap-add, to keep the transforms small.
+        The blocks are kept in complex64 for float32 images.
+    """
+    padded = np.pad(im, pad, mode='symmetric')
+    if block is None:
+        # equal blocks of FFT_BLOCK to 2*FFT_BLOCK, with no thin strips left
+        block = tuple(-(-s//max(s//FFT_BLOCK, 1)) for s in padded.shape)
+    fshape = tuple(fast_len(b + 2*pad) for b in block)
+    ctype = np.result_type(im.dtype, np.complex64)
+    blocks = {}
+    for i in xrange(0, padded.shape[0], block[0]):
+        for j in xrange(0, padded.shape[1], block[1]):
+            blocks[i, j] = np.fft.rfft2(padded[i:i+block[0], j:j+block[1]],
+                                        fshape).astype(ctype, copy=False)
+    return Spectrum(im.shape, pad, block, fshape, blocks, im.dtype)
+
+_kernel_spectra = {}
+
+def kernel_spectrum(csize, fshape, dtype=np.complex128):
+    """ kernel_spectrum(csize, fshape, dtype=complex128)
+        return the fft of kernel(csize) at size fshape as dtype, that of
+        the image spectrum it multiplies, cached by (csize, sign, fshape,
+        dtype) so it is only computed once per run
+    """
+    key = (abs(csize), np.sign(csize), fshape, np.dtype(dtype))
+    try:
+        return _kernel_spectra[key]
+    except KeyError:
+        kspec = np.fft.rfft2(kernel(csize), fshape).astype(dtype)
+        _kernel_spectra[key] = kspec
+        return kspec
+
+def fft_convolve(im, csize, spectrum=None):
+    """ fft_convolve(im, csize, spectrum=None)
+        Convolves the image with kernel(csize) by fft; the result is the same
+        as ndimage.convolve(im, kernel(csize)) with the default 'reflect' mode.
+
+        Input:
+            im          the image
+            csize       the kernel size, as in label_particles_convolve
+            spectrum    image_spectrum(im, pad) to reuse for several kernels;
+                        pad must be at least the kernel half-width
+    """
+    w = kernel(csize).shape[0]//2
+    if spectrum is None:
+        spectrum = image_spectrum(im, w)
+    elif spectrum.pad < w:
+        raise ValueError('spectrum pad {} too small for csize {}'.format(
+                         spectrum.pad, csize))
+    # in single precision the products stay complex64
+    ctype = np.result_type(spectrum.dtype, np.complex64)
+    kspec = kernel_spectrum(csize, spectrum.fshape, ctype)
+    full = np.zeros([s + 2*spectrum.pad + 2*w for s in spectrum.shape], spectrum.dtype)
+    for (i, j), bspec in spectrum.blocks.iteritems():
+        conv = np.fft.irfft2(bspec*kspec, spectrum.fshape)
+        h, v = min(conv.shape[0], full.shape[0]-i), min(conv.shape[1], full.shape[1]-j)
+        full[i:i+h, j:j+v] += conv[:h, :v]
+    o = spectrum.pad + w
+    return full[o:o+spectrum.shape[0], o:o+spectrum.shape[1]]
+
+def associate_corners(cpts, pts, maxdist=np.sqrt(DIST_THRESH)):
+    """ associate_corners(cpts, pts, maxdist=sqrt(DIST_THRESH)) -> owner
+        Finds the nearest center for each corner dot with a single kd-tree
+        query, returning the index into pts of the owning center for each
+        dot in cpts, or -1 for dots further than maxdist from all centers.
+    """
+    owner = -np.ones(len(cpts), int)
+    if len(cpts) and len(pts):
+        tree = cKDTree(np.column_stack((pts['x'], pts['y'])))
+        dist, nearest = tree.query(np.column_stack((cpts['x'], cpts['y'])),
+                                   distance_upper_bound=maxdist)
+        found = np.isfinite(dist)
+        owner[found] = nearest[found]
+    return owner
+
 def remove_segments(orig, particles, labels):
     """ remove_segments(orig, particles, labels)
         attempts to remove the found big dot segment as found in original
     """
     return
 
-def remove_disks(orig, particles, dsk=disk(6)):
+def remove_disks(orig, particles, dsk=disk(6), sparse=True, inplace=False):
     """ remove_disks(method=['disk' or 'segment'])
         removes a disk of given size centered at dot location
         inputs:
             orig   -    input image as ndarray or PIL Image
-            particles - list of particles (namedtuple Segment)
+            particles - particles as array with 'x' and 'y' fields
+                        (as from filter_segments) or list of Segment
             dsk   -    radius of disk, default is skimage.morphology.disk(r)
                             (size of square array is 2*r+1)
+            sparse -   stamp the disk only at the particle positions, rather
+                        than eroding a mask of the full image; unlike the
+                        erosion, this leaves the image border untouched
+            inplace -  with sparse, stamp the disks in orig itself
         output:
             the original image with big dots removed
     """
-    disks = np.ones(orig.shape, int)
     if isinstance(particles[0], Segment):
-        xys = zip(*(map(int,(p.x,p.y)) for p in particles))
+        xys = tuple(map(np.array, zip(*(map(int,(p.x,p.y)) for p in particles))))
+    elif 'x' in particles.dtype.names:
+        xys = np.round(particles['x']).astype(int),np.round(particles['y']).astype(int)
     elif 'X' in particles.dtype.names:
         xys = np.round(particles['X']).astype(int),np.round(particles['Y']).astype(int)
+    if sparse:
+        dx, dy = np.nonzero(dsk)
+        xs = (xys[0][:, None] + dx - dsk.shape[0]//2).ravel()
+        ys = (xys[1][:, None] + dy - dsk.shape[1]//2).ravel()
+        inside = (xs >= 0) & (xs < orig.shape[0]) & (ys >= 0) & (ys < orig.shape[1])
+        removed = orig if inplace else np.array(orig)
+        removed[xs[inside], ys[inside]] = 0
+        return removed
+    disks = np.ones(orig.shape, int)
     disks[xys] = 0
     disks = binary_erosion(disks,dsk)
     return orig*disks
 
+def find_container(im, rmin=None, rmax=None, scale=4, size=256):
+    """ find_container(im, rmin=None, rmax=None, scale=4, size=256) -> (x, y, r)
+        Finds the circular container in the image (best given the mean of
+        several frames) by hough transform of the canny edges of a copy
+        reduced to about size on its smaller side (but at least by scale),
+        so the accumulator stays small for full resolution frames. The
+        radius is sought between rmin and rmax, by default 0.3 and 0.55 of
+        the smaller side of the image. If the image was reduced by more
+        than scale, the circle is refined by a least squares fit to the
+        edges of a copy reduced by scale that lie near it.
+    """
+    from skimage.transform import hough_circle
+    side = min(im.shape)
+    if rmin is None: rmin = 0.3*side
+    if rmax is None: rmax = 0.55*side
+    coarse = max(scale, side//size)
+    radii = np.arange(int(rmin/coarse), int(rmax/coarse) + 1)
+    hough = hough_circle(canny(block_mean(im, coarse), sigma=2), radii)
+    r, x, y = np.unravel_index(hough.argmax(), hough.shape)
+    x, y, r = (x + .5)*coarse - .5, (y + .5)*coarse - .5, radii[r]*coarse
+    if coarse == scale:
+        return x, y, r
+
+    ex, ey = np.nonzero(canny(block_mean(im, scale), sigma=2))
+    ex, ey = (ex + .5)*scale - .5, (ey + .5)*scale - .5
+    near = np.abs(np.hypot(ex - x, ey - y) - r) < 2*coarse
+    if near.sum() < 3:
+        return x, y, r
+    # algebraic fit of x**2 + y**2 = 2*a*x + 2*b*y + c
+    ex, ey = ex[near], ey[near]
+    a, b, c = np.linalg.lstsq(np.column_stack((2*ex, 2*ey, np.ones_like(ex))),
+                              ex**2 + ey**2)[0]
+    return a, b, np.sqrt(c + a**2 + b**2)
+
+def save_roi(roifile, roi):
+    """ save_roi(roifile, (x, y, r)) saves the circle of interest """
+    with open(roifile, 'w') as f:
+        f.write('# x y r\n%.2f %.2f %.2f\n' % tuple(roi))
+
+def load_roi(roifile):
+    """ load_roi(roifile) -> (x, y, r) """
+    return tuple(np.loadtxt(roifile))
+
+def crop_roi(im, roi):
+    """ crop_roi(im, roi) -> cropped image, (x0, y0)
+        Crops the image to the bounding box of the circle roi = (x, y, r),
+        and fills the pixels outside the circle with the mean inside it.
+        Returns the cropped image and the position of its origin in im.
+    """
+    x, y, r = roi
+    x0, y0 = max(int(x - r), 0), max(int(y - r), 0)
+    x1 = min(int(np.ceil(x + r)) + 1, im.shape[0])
+    y1 = min(int(np.ceil(y + r)) + 1, im.shape[1])
+    im = np.array(im[x0:x1, y0:y1])
+    rows, cols = np.ogrid[x0:x1, y0:y1]
+    outside = (rows - x)**2 + (cols - y)**2 > r**2
+    im[outside] = im[~outside].mean()
+    return im, (x0, y0)
+
+def in_roi(pts, roi, offset=(0, 0)):
+    """ in_roi(pts, roi, offset=(0, 0))
+        mask of the pts inside the circle roi = (x, y, r), for pts found in
+        an image cropped at offset
+    """
+    x, y, r = roi
+    return (pts['x'] + offset[0] - x)**2 + (pts['y'] + offset[1] - y)**2 < r**2
+
+def init_worker(cli_args, center_args, corner_args, circle=None, frame_source=None,
+                bg_pattern=None):
+    """ init_worker(args, threshargs, cthreshargs, roi=None, source=None, bg_pattern=None)
+        sets the parsed command line args, the keyword arguments for
+        find_particles for centers and corners, the circle of interest
+        as (x, y, r), and the frames.py source of the images (if not
+        one file per frame) as module globals for get_positions, and
+        resets the record of the previous frame, the histograms and the
+        background model; run once in each worker process
+
+        The background model starts from bg_pattern, as seeded in the main
+        process. It follows the frames only in a single process; a pool's
+        workers each see frames in the order they are handed out, so they
+        keep the seed and the results do not depend on the scheduling.
+    """
+    global args, threshargs, cthreshargs, roi, source, prior, plots, background
+    global histograms, chistograms
+    args, threshargs, cthreshargs = cli_args, center_args, corner_args
+    roi, source = circle, frame_source
+    prior = {}
+    plots = []
+    histograms, chistograms = Histograms(), Histograms()
+    background = None
+    if getattr(args, 'flatfield', False) or getattr(args, 'lighting', False):
+        from background import Background
+        rate = args.bgrate if args.threads == 1 else 0.
+        background = Background(rate, args.bgblock, args.flatfield, bg_pattern)
+
+def plot_positions(savebase, level, pts, labels, convolved=None, dpi=300, verbose=0):
+    """ plot_positions(savebase, level, pts, labels, convolved=None, dpi=300)
+        saves the labels with the positions (level > 1) as
+        savebase_POSITIONS.png, and for level > 2 the convolved image (with
+        the positions for level > 3) as savebase_CONVOLVED.png
+    """
+    plt.clf()
+    labels_mask = labels.astype(float)
+    labels_mask[labels_mask==0] = np.nan
+    plt.imshow(labels_mask, cmap=matplotlib.cm.prism_r)
+    ax = plt.gca()
+    xl, yl = ax.get_xlim(), ax.get_ylim()
+    if level > 1:
+        plt.scatter(pts['y'], pts['x'], s=10, c='r')
+        plt.xlim(xl); plt.ylim(yl)
+    savename = savebase + '_POSITIONS.png'
+    if verbose: print 'saving positions image to', savename
+    plt.savefig(savename, dpi=dpi)
+    if level > 2:
+        plt.clf()
+        plt.imshow(convolved, cmap='gray')
+        if level > 3:
+            plt.scatter(pts['y'], pts['x'], s=10, c='r')
+            plt.xlim(xl); plt.ylim(yl)
+        savename = savebase + '_CONVOLVED.png'
+        if verbose: print 'saving positions with background to', savename
+        plt.savefig(savename, dpi=dpi)
+
+def queue_plot(savebase, pts, labels, convolved=None):
+    """ queue_plot(savebase, pts, labels, convolved=None)
+        adds the arguments for plot_positions to the plots of this frame,
+        to be rendered outside the worker, as compact copies reduced by
+        args.thumb (labels as int32, convolved as float32, pts as x, y)
+    """
+    s = args.thumb
+    xy = np.empty(len(pts), [('x', float), ('y', float)])
+    xy['x'], xy['y'] = pts['x']/s, pts['y']/s
+    labels = np.asarray(labels)[::s, ::s].astype(np.int32)
+    if convolved is not None:
+        convolved = convolved[::s, ::s].astype(np.float32)
+    plots.append((savebase, args.plot, xy, labels, convolved, 300./s, args.verbose))
+
+def render_plot(job):
+    """ render_plot(job) -> plot_positions(*job), for a rendering pool """
+    plot_positions(*job)
+
+def get_positions((n,filename)):
+    """ get_positions((n, filename))
+        finds the particles (and corners) in frame n, using the globals set
+        by init_worker; returns rows of centers (and corners) for output
+
+        With args.window, particles are sought only near their positions in
+        frame n-1 if it was the last frame done by this process, unless
+        args.refresh frames have passed since the last full frame or fewer
+        than args.keep of the particles then found are found.
+    """
+    if args.method == 'brights':
+        return get_brights((n, filename))
+    dtype = PRECISION[args.precision]
+    frame = filename if source is None else source[n]
+    if args.coarse and source is None:
+        # the raw frame serves for both the full and the coarse image
+        frame = imread(filename)
+    im = load_image(frame, dtype, background)
+    if roi is None:
+        offset = (0, 0)
+    else:
+        im, offset = crop_roi(im, roi)
+
+    plot = args.plot and n % args.plotevery == 0
+    windowed = args.window and prior.get('n') == n - 1 \
+                           and n - prior['full'] < args.refresh
+    if windowed:
+        pts = find_particles_windowed(im, prior['pts'], prior['thresh'],
+                                      search=args.window, **threshargs)
+        # fall back to the full frame if particles were lost
+        windowed = len(pts) >= args.keep*prior['count']
+    spectrum = None
+    if windowed:
+        out = (pts,)
+    elif args.coarse:
+        coarse = load_coarse(frame, args.coarse, dtype)
+        pts = find_particles_multires(im, coarse, args.coarse, offset, **threshargs)
+        out = (pts,)
+    else:
+        if args.corner and not args.tile \
+                and max(abs(args.kern), abs(args.ckern)) > FFT_CSIZE:
+            # one transform of the image serves both kernels
+            pad = max(kernel(args.kern).shape[0], kernel(args.ckern).shape[0])//2
+            spectrum = image_spectrum(im, pad)
+        out = find_particles(im, method=args.method, spectrum=spectrum,
+                            return_image=args.plot>2, return_labels=bool(plot),
+                            return_thresh=bool(args.window), **threshargs)
+        if args.window:
+            prior.update(full=n, count=len(out[0]), thresh=out[-1])
+            out = out[:-1]
+        pts = out[0]
+
+    if roi is not None:
+        pts = pts[in_roi(pts, roi, offset)]
+        out = (pts,) + out[1:]
+    prior.update(n=n, pts=pts)
+    histograms.add(pts)
+
+    nfound = len(pts)
+    if nfound < 1:
+        print 'Found no particles in ', path.split(filename)[-1]
+        if args.corner:
+            chistograms.add(pts)
+        return
+    centers = frame_rows(n, pts, offset)
+    print '%20s: Found %d particles' % (path.split(filename)[-1], nfound)
+    savebase = None
+    if plot and len(out) > 1:
+        pdir = path.split(path.abspath(args.output))[0]
+        savebase = path.join(pdir, path.split(filename)[-1].split('.')[-2])
+        queue_plot(savebase, *out)
+
+    if args.corner:
+        if windowed and 'cthresh' in prior:
+            cpts = find_particles_windowed(im, pts, prior['cthresh'],
+                            search=np.sqrt(DIST_THRESH), nearest=False,
+                            rmv=(pts, abs(args.kern)), **cthreshargs)
+            out = (cpts,)
+        else:
+            # the walker cannot remove the centers, so corners are convolved
+            cmethod = 'convolve' if args.method == 'walker' else args.method
+            out = find_particles(im, method=cmethod, spectrum=spectrum,
+                                return_image=args.plot>2, rmv=(pts, abs(args.kern)),
+                                return_labels=bool(plot),
+                                return_thresh=bool(args.window), **cthreshargs)
+            if args.window:
+                prior['cthresh'] = out[-1]
+                out = out[:-1]
+            cpts = out[0]
+
+        if roi is not None:
+            cpts = cpts[in_roi(cpts, roi, offset)]
+        owner = associate_corners(cpts, pts)
+        near = owner >= 0
+        cpts, owner = cpts[near], owner[near]
+        out = (cpts,) + out[1:]
+        chistograms.add(cpts)
+
+        nfound = len(cpts)
+        if nfound < 1:
+            print 'Found no corners, returning only centers'
+            if args.orient:
+                centers = np.column_stack((centers, np.full(len(centers), np.nan)))
+            return centers, np.empty((0, 7))
+        print '%20s: Found %d corners' % (path.split(filename)[-1], nfound)
+        if plot and len(out) > 1:
+            if savebase is None:
+                pdir = path.split(path.abspath(args.output))[0]
+                savebase = path.join(pdir, path.split(filename)[-1].split('.')[-2])
+            queue_plot(savebase+'_CORNER', *out)
+        corners = np.column_stack((frame_rows(n, cpts, offset), owner))
+        if args.orient:
+            from orientation import orient_frame
+            orient = orient_frame(pts, cpts, args.ncorners, args.rcorner, args.drcorner)
+            centers = np.column_stack((centers, orient))
+        return centers, corners
+
+    return centers
+
+def sweep_counts(im, kerns, threshes, mins, maxs, eccs, roi=None, offset=(0, 0)):
+    """ sweep_counts(im, kerns, threshes, mins, maxs, eccs) -> rows
+        Counts the particles find_particles(im, method='convolve') would
+        find for every combination of the given kernel sizes, thresholds
+        (integers, in standard deviations), and minimum area, maximum area
+        and maximum eccentricity cuts. The image is convolved once per
+        kernel (from one shared transform) and labeled once per threshold;
+        the cuts are then array filters of the unfiltered segment_stats.
+        With roi, only particles inside it count, as in_roi(pts, roi, offset).
+
+        Returns rows of (kern, thresh, min, max, ecc, count).
+    """
+    mins, maxs, eccs = map(np.asarray, (mins, maxs, eccs))
+    spectrum = None
+    if max(map(abs, kerns)) > FFT_CSIZE:
+        spectrum = image_spectrum(im, max(kernel(k).shape[0] for k in kerns)//2)
+    intensity = 1 - im
+    grid = np.array(np.broadcast_arrays(mins[:, None, None], maxs[None, :, None],
+                                        eccs[None, None, :])).reshape(3, -1).T
+    rows = []
+    for k in kerns:
+        convolved = convolve_thresh(im, 0., csize=k, spectrum=spectrum)[0]
+        mean, std = convolved.mean(), convolved.std()
+        for t in threshes:
+            pts = segment_stats(label(convolved > mean + t*std), intensity)
+            if roi is not None:
+                pts = pts[in_roi(pts, roi, offset)]
+            count = ((pts['area'] >= grid[:, 0, None]) &
+                     (pts['area'] <= grid[:, 1, None]) &
+                     (pts['ecc'] <= grid[:, 2, None])).sum(1)
+            rows.append(np.column_stack((np.tile([k, t], (len(grid), 1)), grid, count)))
+    return np.concatenate(rows)
+
+def sweep_task((n, filename)):
+    """ sweep_task((n, filename)) -> rows of sweep_counts for frame n, with
+        the grid of the args.sweep* options, preceded by the frame number
+    """
+    im = load_image(filename if source is None else source[n],
+                    PRECISION[args.precision])
+    if roi is None:
+        offset = (0, 0)
+    else:
+        im, offset = crop_roi(im, roi)
+    rows = sweep_counts(im, args.sweepkern, args.sweepthresh, args.sweepmin,
+                        args.sweepmax, args.sweepecc, roi, offset)
+    print '%20s: swept %d parameter sets' % (path.split(filename)[-1], len(rows))
+    return np.column_stack((np.full(len(rows), n), rows))
+
+def get_brights((n, filename)):
+    """ get_brights((n, filename))
+        finds the bright spots in frame n with find_brights, with the
+        thresholds, areas and circularities of args; returns rows for output
+    """
+    frame = imread(filename) if source is None else source[n]
+    if background is not None:
+        background.update(frame if frame.ndim == 2 else frame[..., 1])
+    pts, labels = find_brights(frame, args.brights[0], args.brights[1],
+                               args.min, args.max, args.circularity[0],
+                               args.circularity[1], roi)
+    histograms.add(pts)
+    if len(pts) < 1:
+        print 'Found no particles in ', path.split(filename)[-1]
+        return
+    print '%20s: Found %d particles' % (path.split(filename)[-1], len(pts))
+    if args.plot and n % args.plotevery == 0:
+        pdir = path.split(path.abspath(args.output))[0]
+        savebase = path.join(pdir, path.split(filename)[-1].split('.')[-2])
+        queue_plot(savebase, pts, labels, frame)
+    return frame_rows(n, pts)
+
+def positions_task(task):
+    """ positions_task((n, filename)) -> n, (get_positions((n, filename)), plots, brightness, hists)
+        with the plot_positions arguments queued for the frame, its
+        brightness if the background is modeled, and the histograms of its
+        centers and corners, to be merged by the caller
+    """
+    global histograms, chistograms
+    del plots[:]
+    histograms, chistograms = Histograms(), Histograms()
+    result = get_positions(task)
+    brightness = None if background is None else background.brightness
+    return task[0], (result, plots[:], brightness, (histograms, chistograms))
+
+def reorder(results):
+    """ reorder(results)
+        yields (n, result) pairs arriving in any order in order of n,
+        starting from 0, holding back those that arrive early
+    """
+    pending = {}
+    nextn = 0
+    for n, result in results:
+        pending[n] = result
+        while nextn in pending:
+            yield nextn, pending.pop(nextn)
+            nextn += 1
+
 if __name__ == '__main__':
     import matplotlib
     matplotlib.use('Agg')
     import matplotlib.pyplot as pl
     from multiprocessing import Pool
+    from itertools import imap, chain
+    from collections import deque
     from argparse import ArgumentParser
-    from os import path
+    from time import time
+    from posfile import PositionsWriter, binary_name, histogram_name
+    from frames import open_frames, FileFrames, Prefetch, watch_files
+    from background import Background
 
     parser = ArgumentParser()
     parser.add_argument('files', metavar='FILE', nargs='+',
                         help='Images to process')
     parser.add_argument('-p', '--plot', action='count',
                         help="Produce a plot for each image. Use more p's for more images")
+    parser.add_argument('--plotevery', default=1, type=int, metavar='K',
+                        help='With -p, plot only every K-th frame')
+    parser.add_argument('--thumb', default=1, type=int,
+                        help='With -p, plot images reduced by THUMB, at lower resolution')
+    parser.add_argument('--plotthreads', default=1, type=int,
+                        help='Number of processes rendering plots, apart from the workers')
     parser.add_argument('-v', '--verbose', action='count',
                         help="Control verbosity")
     parser.add_argument('-o', '--output', default='POSITIONS',
                         help='Output file')
     parser.add_argument('-N', '--threads', default=1, type=int,
                         help='Number of worker threads')
+    parser.add_argument('--chunk', default=0, type=int,
+                        help='Frames sent to a worker at a time (default: automatic)')
+    parser.add_argument('--report', default=100, type=int,
+                        help='Report progress and speed every REPORT frames')
+    parser.add_argument('-b', '--binary', action='store_true',
+                        help='Write binary output (with frame index) instead of text')
+    parser.add_argument('--tile', default=0, type=int,
+                        help='Find particles in tiles of this size, to bound memory use')
+    parser.add_argument('--tilethreads', default=4, type=int,
+                        help='Number of threads working on the tiles of one frame')
+    parser.add_argument('--window', default=0, type=float,
+                        help='Seek particles only within this distance of their '
+                             'positions in the previous frame (0 to seek in full frames)')
+    parser.add_argument('--refresh', default=50, type=int,
+                        help='With --window, search the full frame at least every REFRESH frames')
+    parser.add_argument('--keep', default=.95, type=float,
+                        help='With --window, search the full frame if fewer than this '
+                             'fraction of the particles in the last full frame are found')
+    parser.add_argument('--watch', default=0, type=float, metavar='INTERVAL',
+                        help='Process frames as they are written, checking the FILE '
+                             'pattern (quoted) for new files every INTERVAL seconds')
+    parser.add_argument('--idle', default=60, type=float,
+                        help='With --watch, stop when no frame has arrived for IDLE seconds')
+    parser.add_argument('--raw', type=int, nargs=2, metavar=('ROWS', 'COLS'),
+                        help='FILE is a raw dump of frames of this shape')
+    parser.add_argument('--rawtype', default='<u2',
+                        help='Data type of raw frames, default is <u2 (uint16)')
+    parser.add_argument('--rawoffset', default=0, type=int,
+                        help='Header size in bytes of raw file')
+    parser.add_argument('--prefetch', default=4, type=int,
+                        help='Frames to read ahead in the background (0 to disable)')
     parser.add_argument('-c', '--corner', action='store_true',
                         help='Also find small corner dots')
     parser.add_argument('--slr', action='store_true',
                         help='Full resolution SLR was used')
+    parser.add_argument('--coarse', default=0, type=int,
+                        help='Find particles in the image reduced by COARSE, '
+                             'then refine them in windows of the full image, '
+                             'each thresholded at half its own maximum')
+    parser.add_argument('--precision', default='double', choices=sorted(PRECISION),
+                        help='Precision of images in memory; single halves memory use')
+    parser.add_argument('-m', '--method', default='convolve',
+                        choices=['convolve', 'peaks', 'walker', 'brights'],
+                        help='Find particles as thresholded regions of the convolved image, '
+                             'as its local maxima, by random walker (full frames only), or '
+                             'as bright spots like find_brights.imj (see --brights)')
+    parser.add_argument('--brights', default=[101, 255], type=float, nargs=2,
+                        metavar=('LOW', 'HIGH'),
+                        help='With --method brights, the range of pixel values of the spots; '
+                             'their area is --min to --max (default 50 to 300)')
+    parser.add_argument('--circularity', default=[.5, 1.], type=float, nargs=2,
+                        metavar=('MIN', 'MAX'),
+                        help='With --method brights, the range of circularity of the spots')
+    parser.add_argument('--walkscale', default=4, type=int,
+                        help='With --method walker, solve first on the image reduced '
+                             'by WALKSCALE, then at full size near the boundaries')
+    parser.add_argument('--walktol', default=1e-3, type=float,
+                        help='Tolerance of the random walker solver')
     parser.add_argument('-k', '--kern', default=0, type=float,
                         help='Kernel size for convolution')
     parser.add_argument('--min', default=-1, type=int,
@@ -241,16 +1331,84 @@ if __name__ == '__main__':
                         help='Maximum area for corner dots')
     parser.add_argument('--cecc', default=.8, type=float,
                         help='Maximum eccentricity for corner dots')
+    parser.add_argument('--sweep', default=0, type=int, metavar='NFRAMES',
+                        help='Instead of finding positions, count the particles found in '
+                             'NFRAMES frames spread over the files for every combination of '
+                             'the --sweep* values, and save the counts (to the output name with '
+                             'SWEEP for POSITIONS)')
+    parser.add_argument('--sweepkern', type=float, nargs='+',
+                        help='Kernel sizes to sweep (default: --kern)')
+    parser.add_argument('--sweepthresh', default=[3], type=int, nargs='+',
+                        help='Thresholds to sweep, in standard deviations')
+    parser.add_argument('--sweepmin', type=float, nargs='+',
+                        help='Minimum areas to sweep (default: --min)')
+    parser.add_argument('--sweepmax', type=float, nargs='+',
+                        help='Maximum areas to sweep (default: --max)')
+    parser.add_argument('--sweepecc', type=float, nargs='+',
+                        help='Maximum eccentricities to sweep (default: --ecc)')
+    parser.add_argument('--flatfield', action='store_true',
+                        help='Divide frames by a model of the background illumination, '
+                             'seeded from the first 1/BGRATE frames, and running only with -N 1')
+    parser.add_argument('--bgrate', default=.05, type=float,
+                        help='Rate at which the background model follows the frames')
+    parser.add_argument('--bgblock', default=32, type=int,
+                        help='Size of the blocks (larger than a particle) over which '
+                             'the background is taken as a median')
+    parser.add_argument('--lighting', action='store_true',
+                        help='Save the brightness of each frame (the flicker trace of '
+                             'lighting.py) to the output name with LIGHTING for POSITIONS')
+    parser.add_argument('--orient', action='store_true',
+                        help='With -c, also find the orientation of each particle from its '
+                             'corner dots, saved as another column; the corners are chosen as '
+                             'by otracks.py -o, but with more than one (--ncorners) the angle '
+                             'is the circular mean of their directions, not that of '
+                             'get_angles_loop')
+    parser.add_argument('--ncorners', type=int, default=3,
+                        help='With --orient, number of corner dots per particle')
+    parser.add_argument('--rcorner', type=float, default=10,
+                        help='With --orient, distance to corner dot from central dot')
+    parser.add_argument('--drcorner', type=float, default=-1,
+                        help='With --orient, allowed error in rcorner (default sqrt(rcorner))')
     parser.add_argument('--circ', action='store_true',
                         help='Open the first image and specify the circle of interest')
+    parser.add_argument('--roi', metavar='ROIFILE',
+                        help='Circle of interest file (x y r); if it does not exist, '
+                             'the container is found and the circle saved to it')
+    parser.add_argument('--roiframes', default=10, type=int,
+                        help='Number of frames to average to find the container')
     args = parser.parse_args()
 
-    if '*' in args.files[0] or '?' in args.files[0]:
+    if args.watch:
+        if args.sweep:
+            parser.error('--sweep needs the whole run')
+        # frames are read by name as they arrive; the first is needed to start
+        print "Watching for", args.files[0]
+        watched = watch_files(args.files[0], args.watch, args.idle)
+        filenames = [next(watched, None)]
+        if filenames[0] is None:
+            parser.error('no frames arrived')
+        args.prefetch = 0
+    elif '*' in args.files[0] or '?' in args.files[0]:
         from glob import glob
         filenames = sorted(glob(args.files[0]))
     else:
         filenames = sorted(args.files)
 
+    source = open_frames(filenames, args.raw, args.rawtype, args.rawoffset)
+    stacked = not isinstance(source, FileFrames)
+    if stacked and args.watch:
+        parser.error('--watch needs one image file per frame')
+    if stacked:
+        filenames = [source.name(n) for n in xrange(len(source))]
+        print "Reading {} frames from {}".format(len(filenames), args.files[0])
+    if args.prefetch:
+        source = Prefetch(source, args.prefetch)
+    elif isinstance(source, FileFrames):
+        source = None
+
+    if args.method == 'brights':
+        if args.min == -1: args.min = 50
+        if args.max == np.inf: args.max = 300
     kern_area = np.pi*args.kern**2
     if args.min == -1:
         args.min = kern_area/2
@@ -264,7 +1422,7 @@ if __name__ == '__main__':
     if args.cmax == np.inf: args.cmax = 2*ckern_area
 
     if args.circ:
-        first_img = imread(filenames[0])
+        first_img = imread(filenames[0]) if source is None else source[0]
         x = []
         y = []
         origin = []
@@ -290,12 +1448,25 @@ if __name__ == '__main__':
 
         viewer.canvas.mpl_connect('button_press_event', on_click)
         viewer.show()
-        origin = origin[0]
-        r2 = r2[0]
+        roi = origin[0] + (r2[0]**.5,)
+        if args.roi:
+            save_roi(args.roi, roi)
+    elif args.roi and path.exists(args.roi):
+        roi = load_roi(args.roi)
+        print "Using circle of interest", roi, "from", args.roi
+    elif args.roi:
+        print "Finding container in first {} frames".format(args.roiframes)
+        nmean = min(args.roiframes, len(filenames))
+        mean_img = sum(imread(filenames[i]).astype(float) if source is None
+                       else source[i].astype(float) for i in xrange(nmean))/nmean
+        if mean_img.ndim == 3:
+            mean_img = mean_img[..., 1]
+        roi = find_container(mean_img)
+        print "Found circle of interest", roi, "saving to", args.roi
+        save_roi(args.roi, roi)
+    else:
+        roi = None
 
-    if args.plot:
-        cm = pl.cm.prism_r
-        pdir = path.split(path.abspath(args.output))[0]
     threshargs =  {'max_ecc' : args.ecc,
                    'min_area': args.min,
                    'max_area': args.max,
@@ -304,6 +1475,29 @@ if __name__ == '__main__':
                    'min_area': args.cmin,
                    'max_area': args.cmax,
                    'csize'   : args.ckern}
+    if sum(map(bool, (args.tile, args.window, args.coarse))) > 1:
+        parser.error('only one of --tile, --window and --coarse can be used')
+    if args.coarse and abs(args.kern) < 2*args.coarse:
+        # the coarse kernel and areas shrink to a pixel or two, and most
+        # particles are missed
+        parser.error('--coarse {} needs |--kern| of at least {}; it is meant '
+                     'for large (SLR) particles'.format(args.coarse, 2*args.coarse))
+    if args.tile and args.method != 'convolve':
+        parser.error('--tile works only with --method convolve')
+    if args.method in ('walker', 'brights'):
+        if args.window or args.coarse:
+            parser.error('--method {} works only on full frames'.format(args.method))
+    if args.method == 'walker':
+        threshargs.update(scale=args.walkscale, tol=args.walktol)
+    if args.orient and not args.corner:
+        parser.error('--orient needs the corners (-c)')
+    if args.drcorner == -1:
+        args.drcorner = np.sqrt(args.rcorner)
+    if args.method == 'brights' and args.corner:
+        parser.error('--method brights does not find corners')
+    if args.tile:
+        for targs in threshargs, cthreshargs:
+            targs.update(tile=args.tile, nthreads=args.tilethreads)
     #threshargs =  {'max_ecc' :   .7 if args.slr else  .7, # .6
     #               'min_area':  800 if args.slr else  15, # 870
     #               'max_area': 1600 if args.slr else 200, # 1425
@@ -313,126 +1507,145 @@ if __name__ == '__main__':
     #               'max_area': 200 if args.slr else 36, # 180
     #               'csize'   :   5 if args.slr else  2}
 
-    def plot_positions(savebase, level, pts, labels, convolved=None,):
-        pl.clf()
-        labels_mask = labels.astype(float)
-        labels_mask[labels_mask==0] = np.nan
-        pl.imshow(labels_mask, cmap=cm)
-        ax = pl.gca()
-        xl, yl = ax.get_xlim(), ax.get_ylim()
-        if level > 1:
-            ptsarr = np.asarray(pts)
-            pl.scatter(ptsarr[:,1], ptsarr[:,0], s=10, c='r')#ptsarr[:,2], cmap=cm)
-            pl.xlim(xl); pl.ylim(yl)
-        savename = savebase + '_POSITIONS.png'
-        if args.verbose: print 'saving positions image to', savename
-        pl.savefig(savename, dpi=300)
-        if level > 2:
-            pl.clf()
-            pl.imshow(convolved, cmap='gray')
-            if args.plot > 3:
-                ptsarr = np.asarray(pts)
-                pl.scatter(ptsarr[:,1], ptsarr[:,0], s=10, c='r')#ptsarr[:,2], cmap=cm)
-                pl.xlim(xl); pl.ylim(yl)
-            savename = savebase + '_CONVOLVED.png'
-            if args.verbose: print 'saving positions with background to', savename
-            pl.savefig(savename, dpi=300)
-
-    def get_positions((n,filename)):
-        out = find_particles(filename, method='convolve',
-                            return_image=args.plot>2, **threshargs)
-        if args.plot > 2:
-            pts, labels, convolved = out
+    if args.sweep:
+        for opt in 'kern', 'min', 'max', 'ecc':
+            if getattr(args, 'sweep' + opt) is None:
+                setattr(args, 'sweep' + opt, [getattr(args, opt)])
+        frames = np.unique(np.linspace(0, len(filenames) - 1, args.sweep).astype(int))
+        tasks = [(n, filenames[n]) for n in frames]
+        # the swept frames are far apart, nothing to read ahead
+        if isinstance(source, Prefetch):
+            source = source.source
+        initargs = (args, threshargs, cthreshargs, roi, source)
+        if args.threads > 1:
+            results = Pool(args.threads, init_worker, initargs).map(sweep_task, tasks)
         else:
-            pts, labels = out
+            init_worker(*initargs)
+            results = map(sweep_task, tasks)
+        soutput = args.output.replace('POSITIONS', 'SWEEP') \
+                  if 'POSITIONS' in args.output else args.output + '_SWEEP.txt'
+        print "Saving sweep counts to", soutput
+        np.savetxt(soutput, np.concatenate(results),
+                   fmt=['%6d', '%5.2f', '%6d', '%8.1f', '%8.1f', '%5.2f', '%6d'],
+                   header='Frame  Kern Thresh  Min area Max area Ecc  Count')
+        raise SystemExit
 
-        if args.circ:
-            pts = [p for p in pts if (p.x - origin[0])**2 + (p.y - origin[1])**2 < r2]
-            out = (pts,) + out[1:]
+    if 'CORNER' in args.output:
+        coutput = args.output
+    elif 'POSITIONS' in args.output:
+        coutput = args.output.replace('POS','CORNER_POS')
+    else:
+        outnames = args.output.split('.')
+        outnames.insert(-1, '_CORNER.')
+        coutput = ''.join(outnames)
+    if 'CORNER_' in args.output:
+        args.output = args.output.replace('CORNER_','')
+    elif 'CORNER' in args.output:
+        args.output = args.output.replace('CORNER','')
+    if args.binary:
+        args.output, coutput = binary_name(args.output), binary_name(coutput)
 
-        nfound = len(pts)
-        if nfound < 1:
-            print 'Found no particles in ', path.split(filename)[-1]
-            return
-        centers = np.hstack([n*np.ones((nfound,1)), pts])
-        print '%20s: Found %d particles' % (path.split(filename)[-1], nfound)
-        if args.plot:
-            savebase = path.join(pdir, path.split(filename)[-1].split('.')[-2])
-            plot_positions(savebase, args.plot, *out)
+    output = PositionsWriter(args.output, args.kern, args.min, args.max,
+                             args.ecc, binary=args.binary, orient=args.orient)
+    print "Saving positions to ", args.output
+    if args.corner:
+        coutput = PositionsWriter(coutput, args.ckern, args.cmin, args.cmax,
+                                  args.cecc, corner=True, binary=args.binary)
+        print "Saving corner positions to ", coutput.path
+    if args.lighting:
+        loutput = args.output.replace('POSITIONS', 'LIGHTING') \
+                  if 'POSITIONS' in args.output else args.output + '_LIGHTING.txt'
+        loutput = path.splitext(loutput)[0] + '.txt'
+        print "Saving lighting trace to", loutput
+        lighting = open(loutput, 'w')
+        lighting.write('# Frame    Brightness\n')
 
-        if args.corner:
-            out = find_particles(filename, method='convolve',
-                                return_image=args.plot>2, rmv=(pts, abs(args.kern)),
-                                 **cthreshargs)
-            if args.plot > 2:
-                cpts, clabels, cconvolved = out
-            else:
-                cpts, clabels = out
-
-            if args.circ:
-                cpts = [p for p in cpts if (p.x - origin[0])**2 + \
-                        (p.y - origin[1])**2 < r2]
-            old_cpts = cpts[:]
-            cpts = []
-            for pt in old_cpts:
-                for bigpt in pts:
-                    if (pt[0]-bigpt[0])**2 + (pt[1]-bigpt[1])**2 < DIST_THRESH:
-                        cpts.append(pt)
-                        break
-            out = (cpts,) + out[1:]
-
-            nfound = len(cpts)
-            if nfound < 1:
-                print 'Found no corners, returning only centers'
-                return centers
-            print '%20s: Found %d corners' % (path.split(filename)[-1], nfound)
-            if args.plot:
-                plot_positions(savebase+'_CORNER', args.plot, *out)
-            corners = np.hstack([n*np.ones((nfound,1)), cpts])
-            return centers, corners
+    if args.plot:
+        # plots are rendered apart from detection, holding at most a few
+        # frames' plots in waiting
+        renderer = Pool(args.plotthreads)
+        rendering = deque()
 
-        return centers
+    bg_pattern = None
+    if args.flatfield:
+        nseed = min(max(int(round(1/args.bgrate)), 1), len(filenames))
+        print "Modeling the background from the first {} frames".format(nseed)
+        seed = Background(args.bgrate, args.bgblock)
+        for i in xrange(nseed):
+            frame = imread(filenames[i]) if source is None else source[i]
+            seed.update(frame if frame.ndim == 2 else frame[..., 1])
+        bg_pattern = seed.pattern
 
+    initargs = (args, threshargs, cthreshargs, roi, source, bg_pattern)
+    if args.watch:
+        tasks = enumerate(chain(filenames, watched))
+        nframes = '?'
+    else:
+        tasks = enumerate(filenames)
+        nframes = len(filenames)
     if args.threads > 1:
         print "Multiprocessing with {} threads".format(args.threads)
-        p = Pool(args.threads)
-        mapper = p.map
+        chunksize = args.chunk or max(1, min(16, len(filenames)//(8*args.threads)))
+        if args.window:
+            # frames in a chunk are done in order by one worker
+            chunksize = args.refresh
+        if args.watch:
+            # send each frame as soon as it arrives
+            chunksize = 1
+        if isinstance(source, Prefetch):
+            # read ahead only the frames of each worker's own chunk
+            source.chunk = chunksize
+        pool = Pool(args.threads, init_worker, initargs)
+        results = pool.imap_unordered(positions_task, tasks, chunksize)
     else:
-        mapper = map
-    points = filter(lambda x: len(x) > 0, mapper(get_positions, enumerate(filenames)))
-
-    if args.corner:
-        points, corners = map(np.vstack, zip(*points))
-        if 'CORNER' in args.output:
-            coutput = args.output
-        else:
-            if 'POSITIONS' in args.output:
-                coutput = args.output.replace('POS','CORNER_POS')
+        init_worker(*initargs)
+        results = imap(positions_task, tasks)
+    hists, chists = Histograms(), Histograms()
+    start = time()
+    try:
+        for n, (result, frame_plots, brightness, (h, ch)) in reorder(results):
+            hists.merge(h)
+            chists.merge(ch)
+            if args.lighting:
+                lighting.write('%6d     %.6f\n' % (n, brightness))
+                lighting.flush()
+            if args.plot:
+                for job in frame_plots:
+                    while len(rendering) >= 4*args.plotthreads:
+                        rendering.popleft().get()
+                    rendering.append(renderer.apply_async(render_plot, (job,)))
+            if (n + 1) % args.report == 0 or n + 1 == nframes:
+                elapsed = time() - start
+                print "{:6d}/{} frames in {:.0f}s, {:.2f} frames/s".format(
+                        n + 1, nframes, elapsed, (n + 1)/elapsed)
+            if result is None:
+                continue
+            if args.corner:
+                centers, corners = result
+                # make each corner's owner the row of its center in the output
+                corners[:, -1] += output.nrows
+                coutput.write(n, corners)
             else:
-                outnames = args.output.split('.')
-                outnames.insert(-1, '_CORNER.')
-                coutput = ''.join(outnames)
-        with open(coutput, 'w') as coutput:
-            print "Saving corner positions to ", coutput.name
-            coutput.write('# Kern     Min area    Max area      Max eccen\n')
-            coutput.write('#%5.2f%7d%13d%15.2f\n' % (args.ckern, args.cmin, args.cmax, args.cecc))
-            coutput.write('#\n')
-            coutput.write('# Frame    X           Y             Label  Eccen        Area\n')
-            np.savetxt(coutput, corners, delimiter='     ',
-                    fmt=['%6d', '%7.3f', '%7.3f', '%4d', '%1.3f', '%5d'])
-    else:
-        points = np.vstack(points)
-
-    if 'CORNER_' in args.output:
-        args.output = args.output.replace('CORNER_','')
-    elif 'CORNER' in args.output:
-        args.output = args.output.replace('CORNER','')
-    with open(args.output, 'w') as output:
-        print "Saving positions to ", args.output
-        output.write('# Kern     Min area    Max area      Max eccen\n')
-        output.write('#%5.2f%7d%13d%15.2f\n' % (args.kern, args.min, args.max, args.ecc))
-        output.write('#\n')
-        output.write('# Frame    X           Y             Label  Eccen        Area\n')
-        np.savetxt(output, points, delimiter='     ',
-                fmt=['%6d', '%7.3f', '%7.3f', '%4d', '%1.3f', '%5d'])
- 
+                centers = result
+            output.write(n, centers)
+    except KeyboardInterrupt:
+        print "Stopped; the positions of the frames done are saved"
+        if args.threads > 1:
+            pool.terminate()
+    output.close()
+    houtput = histogram_name(args.output)
+    print "Saving histograms to", houtput
+    hists.save(houtput)
+    if args.corner:
+        coutput.close()
+        chists.save(histogram_name(coutput.path))
+    if args.lighting:
+        lighting.close()
+    if args.threads > 1:
+        pool.close()
+        pool.join()
+    if args.plot:
+        for r in rendering:
+            r.get()
+        renderer.close()
+        renderer.join()
@@ -1,43 +1,137 @@
-import matplotlib.pyplot as pl
-from PIL import Image
-import pymeanshift as pms
-import numpy as np
-import multiprocessing as mp
-pool = mp.Pool()
-
-
-nims = 2 # number of images to segment
-
-img = [Image.open('black_white_dots/black_white_dots_%02d.tif'%(i+1)) for i in range(nims)]
-img = pool.map(np.array,img)
-
-segmenter = pms.Segmenter()
-segmenter.spatial_radius = 3
-segmenter.range_radius = 50
-segmenter.min_density = 50
-
-if nims > 1:
-    segout = pool.map(segmenter, img)
-    (segmented, labels, regions) = np.swapaxes(segout,0,1)
-else:
-    (segmented, labels, regions) = segmenter(img)
-
-def segment_centroid(i):
-    return np.mean(np.nonzero(labels == i), axis=1)
-
-if nims == 1:
-    centroids = np.array(pool.map(segment_centroid, range(regions)))
-
-    pl.imshow(img)
-    pl.imshow(segmented, alpha=0.5)
-    pl.plot(img.shape[1] - centroids[:,1], img.shape[0] - centroids[:,0], 'o', alpha=0.2)
-else:
-    for i in range(nims):
-        pl.figure()
-        pl.imshow(img[i])
-        pl.imshow(segmented[i], alpha=0.5)
-        #pl.plot(img[i].shape[1] - centroids[i][:,1], img[i].shape[0] - centroids[i][:,0], 'o', alpha=0.2)
-
-
-pl.show()
-
+#!/usr/bin/env python
+""" segment.py
+    Particle positions by mean shift segmentation (pymeanshift), as another
+    detection method beside those of positions.py.
+
+    Each image is split into regions of similar brightness by the mean shift
+    segmenter, and the regions of the size and shape of a particle are kept.
+    Their centroids, eccentricities and areas come from one pass over the
+    label image (positions.segment_stats), and are returned as arrays of
+    positions.SEGMENT_DTYPE. segment_frames streams many images through the
+    segmenter in a pool of workers.
+"""
+
+import numpy as np
+import pymeanshift as pms
+from PIL import Image
+from positions import segment_stats, frame_rows
+
+def meanshift_regions(img, spatial_radius=3, range_radius=50, min_density=50):
+    """ meanshift_regions(img, spatial_radius=3, range_radius=50, min_density=50)
+        -> segmented, labels, nregions
+        segments the image (uint8, gray or rgb) by mean shift; labels
+        numbers the regions from zero
+    """
+    segmenter = pms.Segmenter()
+    segmenter.spatial_radius = spatial_radius
+    segmenter.range_radius = range_radius
+    segmenter.min_density = min_density
+    return segmenter(img)
+
+def region_positions(labels, max_ecc=0.8, min_area=15, max_area=200, intensity=None):
+    """ region_positions(labels, max_ecc=0.8, min_area=15, max_area=200) -> pts
+        the regions of a meanshift label image meeting the acceptance
+        criteria, as an array of SEGMENT_DTYPE with the region number as
+        label; as positions.filter_segments, but every region counts, the
+        background region (usually too large) as well
+    """
+    pts = segment_stats(np.asarray(labels) + 1, intensity)
+    pts['label'] -= 1
+    keep = (pts['area'] >= min_area) & (pts['area'] <= max_area) \
+         & (pts['ecc'] <= max_ecc)
+    return pts[keep]
+
+def init_worker(ms_args, filter_args):
+    """ init_worker(ms_args, filter_args)
+        sets the keyword arguments for meanshift_regions and
+        region_positions as module globals for segment_task
+    """
+    global msargs, filterargs
+    msargs, filterargs = ms_args, filter_args
+
+def segment_task((n, filename)):
+    """ segment_task((n, filename)) -> n, pts
+        the positions of the particles in image file n
+    """
+    img = np.array(Image.open(filename))
+    labels = meanshift_regions(img, **msargs)[1]
+    return n, region_positions(labels, **filterargs)
+
+def segment_frames(filenames, threads=1, chunksize=4, spatial_radius=3,
+                   range_radius=50, min_density=50, **filter_args):
+    """ segment_frames(filenames, threads=1, chunksize=4, **kwargs)
+        yields (n, pts) for each of the image files in order, with pts of
+        SEGMENT_DTYPE as from positions.find_particles. The images are
+        segmented by threads worker processes, chunksize at a time, and
+        only the frames not yet yielded are held. Other arguments are as
+        for meanshift_regions and region_positions.
+    """
+    initargs = ({'spatial_radius': spatial_radius, 'range_radius': range_radius,
+                 'min_density': min_density}, filter_args)
+    tasks = enumerate(filenames)
+    if threads > 1:
+        from multiprocessing import Pool
+        pool = Pool(threads, init_worker, initargs)
+        try:
+            for result in pool.imap(segment_task, tasks, chunksize):
+                yield result
+        finally:
+            pool.terminate()
+    else:
+        init_worker(*initargs)
+        for task in tasks:
+            yield segment_task(task)
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    from os import path
+    from glob import glob
+    from posfile import PositionsWriter
+
+    parser = ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('files', metavar='FILE', nargs='+',
+                        help='Images to process')
+    parser.add_argument('-o', '--output', default='POSITIONS',
+                        help='Output file')
+    parser.add_argument('-N', '--threads', default=1, type=int,
+                        help='Number of worker threads')
+    parser.add_argument('--chunk', default=4, type=int,
+                        help='Frames sent to a worker at a time')
+    parser.add_argument('--spatial', default=3, type=int,
+                        help='Spatial radius of the mean shift, in px')
+    parser.add_argument('--range', default=50., type=float,
+                        help='Range radius of the mean shift, in gray levels')
+    parser.add_argument('--density', default=50, type=int,
+                        help='Minimum area of a region')
+    parser.add_argument('--min', default=15, type=int,
+                        help='Minimum area')
+    parser.add_argument('--max', default=200, type=int,
+                        help='Maximum area')
+    parser.add_argument('--ecc', default=.8, type=float,
+                        help='Maximum eccentricity')
+    parser.add_argument('-p', '--plot', action='store_true',
+                        help='Show the positions found on the first image')
+    args = parser.parse_args()
+
+    if '*' in args.files[0] or '?' in args.files[0]:
+        filenames = sorted(glob(args.files[0]))
+    else:
+        filenames = sorted(args.files)
+
+    print "Saving positions to ", args.output
+    with PositionsWriter(args.output, 0, args.min, args.max, args.ecc) as output:
+        for n, pts in segment_frames(filenames, args.threads, args.chunk,
+                                     args.spatial, args.range, args.density,
+                                     max_ecc=args.ecc, min_area=args.min,
+                                     max_area=args.max):
+            print '%20s: Found %d particles' % (path.split(filenames[n])[-1], len(pts))
+            output.write(n, frame_rows(n, pts))
+            if args.plot and n == 0:
+                plotted = pts
+
+    if args.plot:
+        import matplotlib.pyplot as pl
+        img = np.array(Image.open(filenames[0]))
+        pl.imshow(img, cmap='gray')
+        pl.plot(plotted['y'], plotted['x'], 'o', alpha=0.2)
+        pl.show()
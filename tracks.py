@@ -4,7 +4,7 @@ from __future__ import division
 import numpy as np
 from PIL import Image as Im
 from itertools import izip
-import sys
+import sys, os
 
 from socket import gethostname
 hostname = gethostname()
@@ -149,7 +149,12 @@ def find_closest(thisdot,trackids,n=1,maxdist=30.,giveup=3):
             return newtrackid
 
 # Tracking
-def load_data(datapath):
+def load_data(datapath, frames=None):
+    """ load_data(datapath, frames=None)
+        loads positions from imagej or positions.py output; for binary
+        positions.py output (*_POSITIONS.bin), frames=(start, stop) loads
+        only frames start <= f < stop
+    """
     print "loading data from",datapath
     if  datapath.endswith('results.txt'):
         shapeinfo = False
@@ -166,14 +171,30 @@ def load_data(datapath):
     elif datapath.endswith('POSITIONS.txt'):
         from numpy.lib.recfunctions import append_fields
         # positions.py output (called *_POSITIONS.txt)
+        # corner files may have a seventh column: the id of the owning center,
+        # and center files one of orientations (positions.py --orient)
+        header = ''
+        with open(datapath) as f:
+            for firstline in f:
+                if not firstline.startswith('#'):
+                    break
+                header = firstline
+        orient = 'Orient' in header
+        owned = not orient and len(firstline.split()) > 6
         data = np.genfromtxt(datapath,
                 skip_header = 1,
-                names = "f,x,y,lab,ecc,area",
-                dtype = [int,float,float,int,float,int])
+                names = "f,x,y,lab,ecc,area" + (",center" if owned else "")
+                                             + (",orient" if orient else ""),
+                dtype = [int,float,float,int,float,int] + ([int] if owned else [])
+                                                        + ([float] if orient else []))
         data = append_fields(data,'id',np.arange(data.shape[0]), usemask=False)
+    elif datapath.endswith('POSITIONS.bin'):
+        # positions.py -b output (called *_POSITIONS.bin)
+        from posfile import load_positions
+        data = load_positions(datapath, frames)
     else:
         print "is {} from imagej or positions.py?".format(datapath.split('/')[-1])
-        print "Please rename it to end with _results.txt or _POSITIONS.txt"
+        print "Please rename it to end with _results.txt or _POSITIONS.txt (or .bin)"
     return data
 
 def find_tracks(data, giveup=1000):
@@ -244,6 +265,8 @@ def find_tracks(data, giveup=1000):
 if __name__=='__main__':
     if loaddata:
         datapath = locdir+prefix+dotfix+'_POSITIONS.txt'
+        if not os.path.exists(datapath) and os.path.exists(datapath[:-4]+'.bin'):
+            datapath = datapath[:-4]+'.bin'
         data = load_data(datapath)
         print "\t...loaded"
     if findtracks: